@@ -1,3 +1,14 @@
 from flask import Flask
+import os
+import startup
+import canisolar
 app = Flask(__name__)
-from app import views
+with startup.timed('import app.views'):
+    from app import views
+with startup.timed('import app.api'):
+    from app import api
+# Under uWSGI the master process imports the app before forking the workers, so warming up here
+# loads the models and key material once, and every worker (including respawns) inherits them.
+# Only the insolation backend in use is built, since the others may not even have their files deployed.
+if os.environ.get('CANISOLAR_WARM_UP'):
+    startup.warm_up(canisolar.warm_up_names() + ['keys'])
@@ -0,0 +1,158 @@
+from flask import request, jsonify, Response
+from app import app
+from app.views import InputError, parse_inputs, make_user
+from canisolar import estimate, month_axis, forecast_axis
+from db import backend_errors
+from insolation import PolyFindError
+from batch import SolarBatch
+import json
+import math
+import pymongo.errors
+import pymysql
+
+api_version = 'v1'
+# The largest number of households a bulk request may hold; override in app.config
+app.config.setdefault('API_MAX_BATCH_SIZE', 1000)
+
+def plain(value):
+    '''
+    Return value with NumPy and pandas types converted to their JSON equivalents, and NaN to None.
+    '''
+    if isinstance(value, dict):
+        return {k: plain(v) for k, v in value.items()}
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [plain(v) for v in value]
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+def api_error(message, status):
+    response = jsonify({'version': api_version, 'error': message})
+    response.status_code = status
+    return response
+
+def public_inputs(inputs):
+    '''Return the validated inputs of a household as they're echoed back to API clients.'''
+    return dict(inputs['loc'], cost=inputs['cost'], month=inputs['month'],
+                ann_demand_met=inputs['ann_demand_met'], efficiency=inputs['efficiency'],
+                net_metering=inputs['net_metering'])
+
+# Errors that an estimate can raise (for some of the households in a batch), e.g. a state missing from the EIA snapshot or the 
+# cost model (KeyError), an unavailable database, or an error in R
+batch_errors = (LookupError, RuntimeError, pymysql.err.Error, pymongo.errors.PyMongoError)
+
+@app.route('/api/v1/estimate')
+def api_estimate():
+    '''
+    Return the estimate that /output renders, as JSON. Takes the same query arguments as /output.
+    '''
+    try:
+        inputs = parse_inputs(request.args)
+        result = estimate(make_user(inputs))
+    except InputError as e:
+        return api_error(str(e), 400)
+    except PolyFindError:
+        return api_error("Sorry, I couldn't find that location.", 404)
+    except backend_errors as e:
+        print("Backend unavailable:", repr(e))
+        return api_error("Sorry, our data is unavailable right now. Please try again in a moment.", 503)
+    except batch_errors as e:
+        print("Estimate failed:", repr(e))
+        return api_error("Sorry, an error occurred.", 500)
+    series = result['graphs']
+    graphs = {'months': list(month_axis()),
+              'forecast_months': list(forecast_axis(len(series['future_costs_before_cum']))),
+              'bills_before': series['bills_before'],
+              'bills_after': series['bills_after'],
+              'insolation': series['insolation'],
+              'future_costs_before_cum': series['future_costs_before_cum'],
+              'future_costs_after_cum': series['future_costs_after_cum']}
+    outputs = {k: result[k] for k in ('req_cap', 'req_area_sqft', 'install_cost', 'breakeven')}
+    # ann_demand_met and efficiency are echoed from the result, since populate() may adjust them
+    inputs = dict(public_inputs(inputs), ann_demand_met=result['ann_demand_met'], efficiency=result['efficiency'])
+    return jsonify(plain({'version': api_version, 'inputs': inputs, 'outputs': outputs, 'graphs': graphs}))
+
+def batch_outputs(households):
+    '''
+    Return a dict mapping the index of each of households (a list of (index, inputs) pairs) to its outputs, or 
+    to an (error message, status) pair. All the households are evaluated in one SolarBatch; if that fails, each 
+    state's households are evaluated in a batch of their own, so that only the failing states get errors.
+    '''
+    try:
+        return populate_batch(households)
+    except batch_errors as e:
+        print("Bulk estimate failed, so retrying state by state:", repr(e))
+    results = {}
+    for state in sorted(set(inputs['loc']['state'] for _, inputs in households)):
+        group = [(i, inputs) for i, inputs in households if inputs['loc']['state'] == state]
+        try:
+            results.update(populate_batch(group))
+        except batch_errors as e:
+            print("Bulk estimate failed for {}: {!r}".format(state, e))
+            results.update({i: ("Sorry, an error occurred.", 500) for i, _ in group})
+    return results
+
+def populate_batch(households):
+    '''Evaluate households (a list of (index, inputs) pairs) in one SolarBatch, and return batch_outputs' dict.'''
+    locs = [inputs['loc'] for _, inputs in households]
+    batch = SolarBatch([loc['lon'] for loc in locs], [loc['lat'] for loc in locs], [loc['state'] for loc in locs],
+                       [inputs['cost'] for _, inputs in households], [inputs['month'] for _, inputs in households],
+                       [inputs['ann_demand_met'] for _, inputs in households],
+                       [inputs['efficiency'] for _, inputs in households])
+    batch.populate()
+    results = {}
+    for row, (i, inputs) in enumerate(households):
+        if not batch.found[row]:
+            results[i] = ("Sorry, I couldn't find that location.", 404)
+        elif not batch.priced[row]:
+            # SolarUser raises KeyError here, which /api/v1/estimate reports as an error
+            results[i] = ("Sorry, an error occurred.", 500)
+        else:
+            results[i] = {'inputs': public_inputs(inputs),
+                          'outputs': {'req_cap': batch.req_cap[row],
+                                      'req_area_sqft': batch.req_area_sqft[row],
+                                      'install_cost': {k: v[row] for k, v in batch.install_cost.items()},
+                                      'breakeven': {k: v[row] for k, v in batch.breakeven.items()}}}
+    return results
+
+@app.route('/api/v1/estimates', methods=['POST'])
+def api_estimates():
+    '''
+    Estimate many households at once. The body is a JSON list of households, or {"households": [...]},
+    each with the same keys as the /output query arguments plus an optional id. All the valid households
+    are evaluated together by one SolarBatch, which looks up each state and insolation polygon only
+    once, and the results stream back as NDJSON, one line per household, in the order given. A household 
+    that can't be estimated gets a line with an error and the status /api/v1/estimate would have returned 
+    for it. Only net metering is supported, and graph series are not included; use /api/v1/estimate for those.
+    '''
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('households')
+    if not isinstance(body, list):
+        return api_error("Expected a JSON list of households, or {\"households\": [...]}.", 400)
+    max_size = app.config['API_MAX_BATCH_SIZE']
+    if len(body) > max_size:
+        return api_error("At most {} households may be estimated per request.".format(max_size), 413)
+    households, results = [], {}
+    for i, household in enumerate(body):
+        try:
+            if not isinstance(household, dict):
+                raise InputError("Each household must be a JSON object.")
+            households.append((i, parse_inputs(household)))
+        except InputError as e:
+            results[i] = (str(e), 400)
+    if households:
+        results.update(batch_outputs(households))
+
+    def generate():
+        for i, household in enumerate(body):
+            line = {'index': i, 'id': household.get('id') if isinstance(household, dict) else None}
+            if isinstance(results[i], tuple):
+                line['error'], line['status'] = results[i]
+            else:
+                line.update(results[i])
+            yield json.dumps(plain(line)) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
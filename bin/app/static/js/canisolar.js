@@ -57,4 +57,15 @@ function getMonthVal() {
 		n = 12;
 	}
 	return n;
-}
\ No newline at end of file
+}
+
+// Graph data comes either as NVD3 series (a list of series with {x, y} points), or as columns 
+// (one x array, and a y array per series) which are much smaller to send. Return NVD3 series either way.
+function graphSeries(data) {
+	if (Array.isArray(data)) {
+		return data;
+	}
+	return data.series.map(function(s) {
+		return {key: s.key, color: s.color, values: s.y.map(function(y, i) { return {x: data.x[i], y: y}; })};
+	});
+}
@@ -1,20 +1,27 @@
-from flask import render_template, request
+from flask import render_template, request, jsonify
 from app import app
-from canisolar import SolarUser, make_graphs
+from canisolar import myr, SolarUser, estimate, render_graphs, get_local_prices, result_cache
 from insolation import PolyFindError
+from startup import Lazy
+import db
+import math
 import us
 import smtplib
 
 valid_state_abbr_list = [state.abbr for state in us.states.STATES if state.abbr != 'AK']
 
-with open('google_maps_api_key.txt', 'r') as f:
-    google_maps_api_key = f.readline()
-    data = {'google_maps_api_key': google_maps_api_key}
+def read_keys():
+    '''
+    Return a dict of the key material used by the app, read from files in the working directory.
+    '''
+    keys = {}
+    for name in ('google_maps_api_key', 'gmail_user', 'gmail_password'):
+        with open(name + '.txt', 'r') as f:
+            keys[name] = f.readline()
+    return keys
 
-with open('gmail_user.txt', 'r') as f:
-    gmail_user = f.readline()
-with open('gmail_password.txt', 'r') as f:
-    gmail_password = f.readline()
+# Read on first use (or startup.warm_up()), not at import
+keys = Lazy('keys', read_keys)
 
 def email_admin(query_string):
     '''
@@ -26,10 +33,10 @@ def email_admin(query_string):
         server.ehlo()
         server.starttls()
         server.ehlo()    
-        server.login(gmail_user, gmail_password)
+        server.login(keys.get()['gmail_user'], keys.get()['gmail_password'])
         #Send the mail
         msg = "\n" + query_string # The /n separates the message from the headers
-        server.sendmail(gmail_user, gmail_user, msg)
+        server.sendmail(keys.get()['gmail_user'], keys.get()['gmail_user'], msg)
     except Exception:
         print("Caught a generic exception in email_admin!")
     finally:
@@ -38,7 +45,8 @@ def email_admin(query_string):
 @app.route('/')
 @app.route('/index')
 def index():
-    data['error_text'] = "Helping you decide if solar power makes sense for you."
+    data = {'google_maps_api_key': keys.get()['google_maps_api_key'], 
+            'error_text': "Helping you decide if solar power makes sense for you."}
     return render_template("input.html", data=data)
 
 @app.route('/input')
@@ -46,118 +54,157 @@ def canisolar_input():
     index()
 
 def canisolar_error(error_text):
-    data['error_text'] = error_text
+    data = {'google_maps_api_key': keys.get()['google_maps_api_key'], 'error_text': error_text}
     return render_template("input.html", data=data)
 
-@app.route('/output')
-def canisolar_output():
+@app.route('/stats')
+def canisolar_stats():
+    '''Hit rates of the estimate and prediction caches, and database pool statistics.'''
+    # Don't load the models just to report on them
+    models = myr.value.stats() if myr.value is not None else None
+    return jsonify({'results': result_cache.stats(), 'models': models, 'db': db.stats()})
+
+class InputError(ValueError):
+    '''
+    Designed to be raised when a request has a missing or invalid input. The message is meant for the user.
+    '''
+    pass
+
+def parse_inputs(args):
+    '''
+    Return a dict of validated inputs from the /output query arguments, or any dict with the same keys 
+    (e.g. one household in a bulk API request). Raises InputError.
+    '''
+    address = args.get('address')
+    cost = args.get('cost')
+    try:
+        # If there are any commas, replace them with nothing
+        # Replace dollar sign with nothing
+        # Try to convert to float
+        cost = float(str(cost).replace(',', '').replace('$', ''))
+        # float() accepts 'nan' and 'inf', which would get through the range checks
+        if not math.isfinite(cost) or cost < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise InputError("Please enter a valid number for your most recent bill.")
+    month = args.get('month')
+    try:
+        month = int(month)
+        if month > 12 or month < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise InputError("Please enter a valid value for the month of your most recent bill.")
     try:
-        address = request.args.get('address')
-        print(address)
-        cost = request.args.get('cost')
-        print(cost)
+        lon = float(args.get('lng'))
+        lat = float(args.get('lat'))
+        if not (math.isfinite(lon) and math.isfinite(lat)):
+            raise ValueError
+    except (TypeError, ValueError):
+        raise InputError("Please enter valid values for latitude and longitude.")
+    state = args.get('state')
+    state_name = args.get('state_name')
+    locality = args.get('locality')
+    zipcode = args.get('zipcode')
+
+    # Construct the DSIRE URL; technology 7 is solar photovoltaics
+    if zipcode:
+        dsire_url = 'http://programs.dsireusa.org/system/program?zipcode={}&technology=7'.format(zipcode)
+    # If we don't have the zipcode, just use the state
+    else:
+        dsire_url = 'http://programs.dsireusa.org/system/program?state={}&technology=7'.format(state)            
+    
+    #if args.get('net_metering'):
+    #    net_metering = True
+    #else:
+    #    net_metering = False
+    net_metering = True
+    
+    loc = {'lon': lon, 'lat': lat, 'state': state, 'state_name': state_name, 'locality': locality, 'zipcode': zipcode}
+    
+    if loc['state'] not in valid_state_abbr_list:
+        raise InputError("Sorry, Can I Solar does not yet support that location.")
+    
+    if args.get('ann_demand_met'):
         try:
-            # If there are any commas, replace them with nothing
-            # Replace dollar sign with nothing
-            # Try to convert to float
-            cost = float(cost.replace(',', '').replace('$', ''))
-            if cost < 0:
+            ann_demand_met_slider_val = float(args.get('ann_demand_met'))
+            if not 0.01 <= ann_demand_met_slider_val <= 1.0:
                 raise ValueError
-        except ValueError:
-            error_text = "Please enter a valid number for your most recent bill."
-            return canisolar_error(error_text)        
-        month = request.args.get('month')
+        except (TypeError, ValueError):
+            raise InputError("Please enter a valid value for consumption supplied by solar.")
+    else:
+        ann_demand_met_slider_val = 0.50
+
+    if args.get('efficiency'):
         try:
-            month = int(month)
-            if month > 12 or month < 1:
+            efficiency_slider_val = float(args.get('efficiency'))
+            if not 0.15 <= efficiency_slider_val <= 0.20:
                 raise ValueError
-        except ValueError:
-            error_text = "Please enter a valid value for the month of your most recent bill."
-            return canisolar_error(error_text)
-        try:
-            lon = float(request.args.get('lng'))
-            lat = float(request.args.get('lat'))
-        except ValueError:
-            error_text = "Please enter valid values for latitude and longitude."
-            return canisolar_error(error_text)
-        state = request.args.get('state')
-        state_name = request.args.get('state_name')
-        locality = request.args.get('locality')
-        zipcode = request.args.get('zipcode')
-
-        # Construct the DSIRE URL; technology 7 is solar photovoltaics
-        if zipcode != '':
-            dsire_url = 'http://programs.dsireusa.org/system/program?zipcode={}&technology=7'.format(zipcode)
-        # If we don't have the zipcode, just use the state
-        else:
-            dsire_url = 'http://programs.dsireusa.org/system/program?state={}&technology=7'.format(state)            
-        
-        #if request.args.get('net_metering'):
-        #    net_metering = True
-        #else:
-        #    net_metering = False
-        net_metering = True
-        
-        loc = {'lon': lon, 'lat': lat, 'state': state, 'state_name': state_name, 'locality': locality, 'zipcode': zipcode}
-        
-        if loc['state'] not in valid_state_abbr_list:
-            error_text = "Sorry, Can I Solar does not yet support that location."
-            return canisolar_error(error_text)        
-        
-        if request.args.get('ann_demand_met'):
-            try:
-                ann_demand_met_slider_val = float(request.args.get('ann_demand_met'))
-                if ann_demand_met_slider_val > 1.0 or ann_demand_met_slider_val < 0.01:
-                    raise ValueError
-            except ValueError:
-                error_text = "Please enter a valid value for consumption supplied by solar."
-                return canisolar_error(error_text)            
-        else:
-            ann_demand_met_slider_val = 0.50
-    
-        if request.args.get('efficiency'):
-            try:
-                efficiency_slider_val = float(request.args.get('efficiency'))
-                if efficiency_slider_val > 0.20 or efficiency_slider_val < 0.15:
-                    raise ValueError
-            except ValueError:
-                error_text = "Please enter a valid value for panel efficiency."
-                return canisolar_error(error_text)                        
-        else:
-            efficiency_slider_val = 0.15
-        
-        user = SolarUser(loc['lon'], loc['lat'], loc['state'], cost, month, 
-						 ann_demand_met=ann_demand_met_slider_val, 
-						 efficiency=efficiency_slider_val, net_metering=net_metering)
-        user.populate()
+        except (TypeError, ValueError):
+            raise InputError("Please enter a valid value for panel efficiency.")
+    else:
+        efficiency_slider_val = 0.15
+
+    # Normalize to the precision of the form (cents, and the sliders' 0.01 steps), so that nearby inputs share 
+    # an estimate cache entry, and that entry holds exactly what was computed for them
+    cost = round(cost, 2)
+    ann_demand_met_slider_val = round(ann_demand_met_slider_val, 2)
+    efficiency_slider_val = round(efficiency_slider_val, 2)
+
+    return {'address': address, 'cost': cost, 'month': month, 'loc': loc, 'dsire_url': dsire_url, 
+            'net_metering': net_metering, 'ann_demand_met': ann_demand_met_slider_val, 
+            'efficiency': efficiency_slider_val}
+
+def make_user(inputs):
+    '''Return a SolarUser for the output of parse_inputs.'''
+    return SolarUser(inputs['loc']['lon'], inputs['loc']['lat'], inputs['loc']['state'], inputs['cost'], inputs['month'], 
+                     ann_demand_met=inputs['ann_demand_met'], efficiency=inputs['efficiency'], 
+                     net_metering=inputs['net_metering'])
+
+@app.route('/output')
+def canisolar_output():
+    print(request.args.get('address'))
+    print(request.args.get('cost'))
+    try:
+        inputs = parse_inputs(request.args)
+    except InputError as e:
+        return canisolar_error(str(e))
+    loc = inputs['loc']
+    try:
+        user = make_user(inputs)
+        # Nearby addresses often have the same inputs, so this is usually cached
+        result = estimate(user)
             
-        # Now we can access the following attributes
-        #user.req_cap
-        #user.req_area_m2
-        #user.req_area_sqft
+        # Now we can access the following items
+        #result['req_cap']
+        #result['req_area_sqft']
         # The following two items are dicts
-        #user.install_cost
-        # We need to check to see if any of these dict items are -1
-        #user.breakeven
+        #result['install_cost']
+        # Any of these dict items may be None, when breakeven lies beyond the 30 year horizon
+        #result['breakeven']
     
-        data = {'google_maps_api_key': google_maps_api_key, 
-                'address': address,
-                'cost': cost, 
-                'month': month, 
-                'ann_demand_met_slider_val': user.ann_demand_met,
-                'efficiency_slider_val': user.efficiency,
-                'loc': loc, 'req_cap': user.req_cap, 
-                'install_cost': user.install_cost, 
-                'breakeven': user.breakeven,
-                'req_area_sqft': user.req_area_sqft, 
-                'net_metering': 'checked' if net_metering else '',
-                'dsire_url': dsire_url}    
+        data = {'google_maps_api_key': keys.get()['google_maps_api_key'], 
+                'address': inputs['address'],
+                'cost': inputs['cost'], 
+                'month': inputs['month'], 
+                'ann_demand_met_slider_val': result['ann_demand_met'],
+                'efficiency_slider_val': result['efficiency'],
+                'loc': loc, 'req_cap': result['req_cap'], 
+                'install_cost': result['install_cost'], 
+                'local_prices': get_local_prices(loc['state'], loc['zipcode']), 
+                'breakeven': result['breakeven'],
+                'req_area_sqft': result['req_area_sqft'], 
+                'net_metering': 'checked' if inputs['net_metering'] else '',
+                'dsire_url': inputs['dsire_url']}    
     
-        graph_data = make_graphs(user, loc)
+        graph_data = render_graphs(result['graphs'], loc)
     
     except PolyFindError:
         error_text = "Sorry, I couldn't find that location."
         return canisolar_error(error_text)
+    except db.backend_errors as e:
+        print("Backend unavailable:", repr(e))
+        error_text = "Sorry, our data is unavailable right now. Please try again in a moment."
+        return canisolar_error(error_text)
     except LookupError as e:
         error_text = "Sorry, an error occurred. The administrator has been notified."
         email_admin(' '.join([str(request.query_string), str(e)]))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:15:15 2026
+
+@author: gjm
+
+This file defines the SolarBatch class, which evaluates many SolarUser scenarios at once.
+SolarUser handles exactly one household and re-runs the whole MongoDB/MySQL/R chain for it;
+SolarBatch fetches the data for each distinct state and location once, and then does all of
+the arithmetic for every row in a single NumPy pass. It is intended for portfolio analyses,
+and serves the bulk estimate API (see app/api.py).
+"""
+
+from insolation import Insolation, PolyFindError
+from canisolar import myr, eia_snapshot, get_insolation_index
+from db import get_mongo_client
+from core import month_lengths, pv_perf_loss_array
+import numpy as np
+import pandas as pd
+
+class SolarBatch(object):
+    '''
+    Pass equal length arrays (or scalars, which are broadcast) of SolarUser inputs. Only the net
+    metering case is supported, i.e. req_cap is always the nominal required capacity.
+    '''
+    def __init__(self, lon, lat, state, cost, month, ann_demand_met=0.5, efficiency=0.15):
+        (self.lon, self.lat, self.state, self.cost, self.month,
+         self.ann_demand_met, self.efficiency) = np.broadcast_arrays(
+            np.asarray(lon, dtype=float), np.asarray(lat, dtype=float), np.asarray(state, dtype=object),
+            np.asarray(cost, dtype=float), np.asarray(month, dtype=int),
+            np.asarray(ann_demand_met, dtype=float), np.asarray(efficiency, dtype=float))
+        self.derate_factor = 0.77
+        self.states = sorted(set(self.state))
+        # One row of insolation (12 months of kWh / m2 / day) per batch row. Identical coordinates
+        # are only looked up once, and rows that fall in the same polygon share the same values.
+        # Rows outside the insolation data (found is False) get NaN insolation, and so NaN output.
+        myInsolation = Insolation(get_insolation_index(), client=get_mongo_client())
+        by_coord = {}
+        by_poly = {None: [np.nan] * 12}
+        self.poly_id = np.empty(len(self), dtype=object)
+        self.insolation = np.empty((len(self), 12))
+        for i, coord in enumerate(zip(self.lon, self.lat)):
+            if coord not in by_coord:
+                try:
+                    poly = myInsolation.poly_find(*coord)[0]
+                    by_coord[coord] = poly['_id']
+                    if poly['_id'] not in by_poly:
+                        by_poly[poly['_id']] = [poly['attributes'][abbr] for abbr in myInsolation.month_abbrs]
+                except PolyFindError:
+                    by_coord[coord] = None
+            self.poly_id[i] = by_coord[coord]
+            self.insolation[i] = by_poly[self.poly_id[i]]
+        self.found = np.array([poly_id is not None for poly_id in self.poly_id], dtype=bool)
+        # Prices (cents per kWh) and average monthly consumption, precomputed per state by the EIA
+        # snapshot and ordered by month number, so that column m - 1 is month m
+        self.state_prices = {state: eia_snapshot.price_vector(state) for state in self.states}
+        self.state_consump = {state: eia_snapshot.consump_profile(state) for state in self.states}
+        self.prices = np.array([self.state_prices[state] for state in self.state])
+        avg_monthly_consump = np.array([self.state_consump[state] for state in self.state])
+        # Same estimates as EIA_DB.est_monthly_consump and EIA_DB.est_annual_consump
+        rows = np.arange(len(self))
+        consump = self.cost / (self.prices[rows, self.month - 1] / 100)
+        self.annual_consumption = avg_monthly_consump * (consump / avg_monthly_consump[rows, self.month - 1])[:, None]
+        self.total_consumption = self.annual_consumption.sum(axis=1)
+        # Rows whose bill month has no price (or no average consumption) can't be estimated; SolarUser 
+        # raises KeyError for them, and here their output is NaN
+        self.priced = np.isfinite(consump) & np.isfinite(self.annual_consumption).all(axis=1)
+    def __len__(self):
+        return len(self.lon)
+    def populate(self):
+        '''
+        Compute the output of SolarUser.populate for every row. Breakeven times that exceed 30 years are None, 
+        as in SolarUser, and all the other output of rows outside the insolation data (found is False) or 
+        without a price for their bill month (priced is False) is NaN.
+        '''
+        kwh_req_per_year = self.total_consumption * self.ann_demand_met
+        solar_hours_per_year = (self.insolation * np.array(month_lengths)).sum(axis=1)
+        self.req_cap = kwh_req_per_year / solar_hours_per_year / self.derate_factor
+        self.req_area_m2 = kwh_req_per_year / (solar_hours_per_year * self.efficiency)
+        self.req_area_sqft = self.req_area_m2 * 10.7639
+        self.install_cost = {k: np.full(len(self), np.nan) for k in ('fit', 'lwr', 'upr')}
+        for state in self.states:
+            rows = (self.state == state) & self.found & self.priced
+            if not rows.any():
+                continue
+            cost = myr.predict_costs(state, self.req_cap[rows])
+            for k in ('fit', 'lwr', 'upr'):
+                self.install_cost[k][rows] = cost[k]
+        self.savings = self.est_savings()
+        cum_savings = self.savings.cumsum(axis=1)
+        self.breakeven = {}
+        for k in ('fit', 'lwr', 'upr'):
+            # Include the 30% federal tax credit
+            net_cost = self.install_cost[k] * 0.70
+            reached = cum_savings >= net_cost[:, None]
+            # argmax finds the first month in which we break even; add 1 because indices begin at 0
+            breakeven = ((reached.argmax(axis=1) + 1) / 12).astype(object)
+            breakeven[~reached.any(axis=1)] = None
+            self.breakeven[k] = breakeven
+    def est_savings(self):
+        '''
+        Return a (rows, 360) array of estimated savings (in $) per month, using forecasted prices.
+        '''
+        forecasts = {state: np.fromiter(myr.predict_prices(state, 360), dtype=float) for state in self.states}
+        prices_forecasted = np.array([forecasts[state] for state in self.state])
+        annual_prod = self.insolation * np.array(month_lengths) * (self.req_cap * self.derate_factor)[:, None]
+        lifetime_prod = np.tile(annual_prod, 30) * pv_perf_loss_array
+        return lifetime_prod * prices_forecasted / 100
+    def to_frame(self):
+        '''
+        Return a pandas DataFrame with one row per scenario, holding the inputs and the populated output.
+        '''
+        frame = pd.DataFrame({'lon': self.lon, 'lat': self.lat, 'state': self.state, 'cost': self.cost,
+                              'month': self.month, 'ann_demand_met': self.ann_demand_met,
+                              'efficiency': self.efficiency, 'req_cap': self.req_cap,
+                              'req_area_m2': self.req_area_m2, 'req_area_sqft': self.req_area_sqft})
+        for k in ('fit', 'lwr', 'upr'):
+            frame['install_cost_' + k] = self.install_cost[k]
+            frame['breakeven_' + k] = self.breakeven[k]
+        return frame
+
+def main():
+    pass
+    #batch = SolarBatch([-72.92, -76.61], [41.31, 39.29], ['CT', 'MD'], [120.0, 95.0], [5, 7])
+    #batch.populate()
+    #print(batch.to_frame())
+
+if __name__ == "__main__":
+    main()
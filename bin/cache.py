@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:16:09 2026
+
+@author: gjm
+
+This file defines the LRUCache class, a small bounded in-process cache that keeps
+hit and miss counters, so that we can see how well each cache is doing.
+
+UWSGICache has the same interface, but keeps its items in a uWSGI cache (declared with a
+cache2 line in uwsgi.ini), so that all the worker processes share them.
+"""
+
+from collections import OrderedDict
+import pickle
+import threading
+import time
+
+class LRUCache(object):
+    '''
+    A dict-like cache that holds at most maxsize items, evicting the least recently used item first. 
+    With a ttl (in seconds), items also expire that long after they were cached.
+    '''
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, expiry time or None)
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+    def __len__(self):
+        return len(self.data)
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data and not self.is_expired(self.data[key])
+    def is_expired(self, item):
+        return item[1] is not None and item[1] <= time.monotonic()
+    def get(self, key, default=None):
+        '''Return the cached value for key, or default if it isn't cached. Counts as a hit or a miss.'''
+        with self.lock:
+            if key in self.data:
+                if not self.is_expired(self.data[key]):
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return self.data[key][0]
+                del self.data[key]
+                self.expired += 1
+            self.misses += 1
+            return default
+    def put(self, key, value):
+        '''Cache value under key, evicting the least recently used item if the cache is full.'''
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+    def get_or_compute(self, key, func, *args):
+        '''Return the cached value for key, calling func(*args) and caching the result on a miss.'''
+        value = self.get(key, self)
+        if value is self:
+            value = func(*args)
+            self.put(key, value)
+        return value
+    def clear(self):
+        '''Drop all cached items. The counters are kept.'''
+        with self.lock:
+            self.data.clear()
+    def stats(self):
+        '''Return a dict of cache statistics.'''
+        lookups = self.hits + self.misses
+        return {'size': len(self.data), 'maxsize': self.maxsize, 'ttl': self.ttl, 'hits': self.hits, 
+                'misses': self.misses, 'expired': self.expired, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+class UWSGICache(object):
+    '''
+    The LRUCache interface over the uWSGI cache called name, which must be declared in uwsgi.ini, e.g.
+
+        cache2 = name=results,items=4000,blocks=8000,blocksize=8192,bitmap=1,purge_lru=1
+
+    uWSGI bounds the number of items (evicting the least recently used, with purge_lru) and expires them 
+    after ttl seconds. Keys are any repr-able values, and values are pickled. Importing uwsgi only works 
+    inside a uWSGI worker, so this raises ImportError anywhere else. Hit and miss counts are shared by all 
+    workers too, in the same cache.
+    '''
+    def __init__(self, name, ttl=None):
+        import uwsgi
+        self.uwsgi = uwsgi
+        self.name = name
+        self.ttl = ttl
+    def key(self, key):
+        return repr(key)
+    def __contains__(self, key):
+        return bool(self.uwsgi.cache_exists(self.key(key), self.name))
+    def count(self, counter):
+        # cache_inc works on 64 bit values; cache_set only stores the initial zero if the counter doesn't exist yet
+        self.uwsgi.cache_set(counter, (0).to_bytes(8, 'little'), 0, self.name)
+        self.uwsgi.cache_inc(counter, 1, 0, self.name)
+    def counter(self, counter):
+        value = self.uwsgi.cache_get(counter, self.name)
+        return int.from_bytes(value, 'little') if value is not None else 0
+    def get(self, key, default=None):
+        '''Return the cached value for key, or default if it isn't cached. Counts as a hit or a miss.'''
+        value = self.uwsgi.cache_get(self.key(key), self.name)
+        if value is None:
+            self.count('__misses__')
+            return default
+        self.count('__hits__')
+        return pickle.loads(value)
+    def put(self, key, value):
+        '''Cache value under key.'''
+        self.uwsgi.cache_update(self.key(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self.ttl or 0, self.name)
+    def get_or_compute(self, key, func, *args):
+        '''Return the cached value for key, calling func(*args) and caching the result on a miss.'''
+        value = self.get(key, self)
+        if value is self:
+            value = func(*args)
+            self.put(key, value)
+        return value
+    def clear(self):
+        '''Drop all cached items, including the counters.'''
+        self.uwsgi.cache_clear(self.name)
+    def stats(self):
+        '''Return a dict of cache statistics, for all workers.'''
+        hits, misses = self.counter('__hits__'), self.counter('__misses__')
+        lookups = hits + misses
+        return {'backend': 'uwsgi', 'name': self.name, 'ttl': self.ttl, 'hits': hits, 'misses': misses,
+                'hit_rate': hits / lookups if lookups else 0.0}
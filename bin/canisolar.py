@@ -9,12 +9,21 @@ together comprise the primary program logic.
 """
 
 from insolation import Insolation
-from eia import EIA_DB
-import calendar
+from eia import EIA_Snapshot
 import numpy as np
-import pandas as pd
 import json
-from r import R
+import functools
+from r import R, CachedR
+from cache import LRUCache, UWSGICache
+from portable import PortableR
+from cost_table import CostTable
+from startup import Lazy
+from spatial import PolygonIndex
+from raster import InsolationRaster
+from db import get_mongo_client, get_mysql_pool, PoolTimeoutError
+import pymysql
+import core
+import os
 import datetime
 import math
 import html
@@ -25,71 +34,215 @@ mysql_url = "localhost"
 mysql_db = "openpv"
 eia_db_url = "localhost"
 eia_db_name = "eia"
-month_lengths = [calendar.monthrange(2015,i)[1] for i in range(1,13)]
-# Construct an array to simulate declining PV panel performance over time.
-# This uses an exponential decay model to create a numpy array of derating factors for 30 years (360 months).
-# The targets are about 90% after 10 years, and about 80% after 25 years, capped at 80%.
-# Model created in R, using the coefficient estimates here. Form is y = e^(a+bx), estimated with nls()
-# These targets are currently industry standards, but can be expected to improve over time.
-pv_perf_loss_array = np.array([math.e**(-0.0053223 + -0.0089347*(i/12)) if i > 1 else 1.0 for i in range(1,361)])
-# We load this once at the beginning, because the models are large and take a while to load
-myr = R("../models/")
+# "memory" loads the insolation polygons once and searches them in process (see spatial.py); 
+# "raster" memory maps a precomputed grid built by raster.py; "mongo" runs a MongoDB query for every lookup
+insolation_backend = "memory"
+insolation_raster_path = "../models/insolation_raster.npy"
+# Exported by portable.py; when present, we predict from it instead of loading the models into R
+model_artifact = "../models/canisolar_models.npz"
+# "model" predicts install costs from the models themselves; "table" interpolates them from the table built 
+# by cost_table.py, which is refused (in favor of the models) if it's missing or less accurate than its bound
+cost_backend = "model"
+cost_table_path = "../models/cost_table.npz"
+# Send graphs as one x array plus y arrays (expanded by canisolar.js) rather than NVD3's lists of points
+graph_columnar = False
+# Estimates are cached by their normalized inputs (see result_key). "uwsgi" shares them between the uWSGI 
+# workers, through the cache declared in uwsgi.ini (falling back to "memory" outside uWSGI); "memory" keeps 
+# them per process. New EIA data for a state changes its keys; entries expire after result_cache_ttl seconds, 
+# so that new models show up.
+result_cache_backend = "uwsgi"
+result_cache_name = "results"
+result_cache_size = 10000
+result_cache_ttl = 3600
 ###############################################################################
 
+def load_models():
+    '''
+    Return the prediction models. Predictions are memoized, since forecasts are deterministic per state 
+    and costs are requested repeatedly.
+    '''
+    model = PortableR(model_artifact) if os.path.exists(model_artifact) else R("../models/")
+    if cost_backend == "table":
+        try:
+            model = CostTable(cost_table_path, model)
+        except (OSError, KeyError, ValueError) as e:
+            print("Not using the cost table, so predicting costs from the models:", e)
+    return CachedR(model)
+
+# We load this once, because the models are large and take a while to load. Loading waits until the first 
+# prediction (or startup.warm_up()), so that importing this module stays cheap.
+myr = Lazy('models', load_models)
+# Only loaded when insolation_backend is "memory" or "raster", respectively
+insolation_index = Lazy('insolation index', lambda: PolygonIndex.from_collection(Insolation(client=get_mongo_client()).db.insolation))
+insolation_raster = Lazy('insolation raster', lambda: InsolationRaster(insolation_raster_path))
+# EIA prices and consumption change once a month, so we serve them from memory rather than querying MySQL
+eia_snapshot = EIA_Snapshot(eia_db_url, eia_db_name)
+
+def make_result_cache():
+    '''
+    Return the cache for estimates, according to result_cache_backend.
+    '''
+    if result_cache_backend == "uwsgi":
+        try:
+            return UWSGICache(result_cache_name, ttl=result_cache_ttl)
+        except ImportError:
+            # e.g. under Flask's development server
+            pass
+    return LRUCache(result_cache_size, ttl=result_cache_ttl)
+
+result_cache = make_result_cache()
+
+def warm_up_names():
+    '''
+    Return the names of the Lazy subsystems that the configured backends use, for startup.warm_up.
+    '''
+    names = ['models']
+    if insolation_backend == "memory":
+        names.append('insolation index')
+    elif insolation_backend == "raster":
+        names.append('insolation raster')
+    return names
+
+def get_insolation_index():
+    '''
+    Return the index that Insolation should search, according to insolation_backend (None for MongoDB).
+    '''
+    if insolation_backend == "memory":
+        return insolation_index.get()
+    if insolation_backend == "raster":
+        return insolation_raster.get()
+    return None
+
+def get_local_prices(state, zipcode, min_installs=5):
+    '''
+    Return a dict with the install cost per watt quantiles (p10, p25, p50, p75, p90), number of installs, and year 
+    of the most recent year in which at least min_installs installs were recorded in zipcode, or in the state if 
+    the zipcode never had that many (in which case the zipcode is None). Reads the price_index table maintained 
+    by OpenPV.refresh_price_index with one primary key lookup. Returns None if no prices are available.
+    '''
+    # The empty zipcode holds the state as a whole, and sorts after any real one
+    sql = '''SELECT zipcode, year, installs, p10, p25, p50, p75, p90 FROM price_index 
+        WHERE state = %s AND zipcode IN (%s, '') AND installs >= %s ORDER BY zipcode DESC, year DESC LIMIT 1'''
+    try:
+        with get_mysql_pool(mysql_url, mysql_db).connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, (state, zipcode or '', min_installs))
+                row = cursor.fetchone()
+    except (pymysql.err.Error, PoolTimeoutError) as e:
+        # The local price range is a nice-to-have, so don't fail the whole request over it
+        print("Local prices unavailable:", e)
+        return None
+    if row is None:
+        return None
+    keys = ('zipcode', 'year', 'installs', 'p10', 'p25', 'p50', 'p75', 'p90')
+    prices = dict(zip(keys, row))
+    prices['zipcode'] = prices['zipcode'] or None
+    return prices
+
 class PredictionBoundError(IndexError):
     '''
     Designed to be raised when predicted breakeven time exceeds 30 years.
     '''
     pass
 
-def dict_to_dict_pairs(mydict):
-    '''
-    Helper function that's useful for NVD3: takes a dict with 12 month number indices (1-12), 
-    and return a list of dictionaries, each of which has 'x' and 'y' keys, where 
-    the 'x' key is also a UNIX timestamp in milliseconds. Since the year is hardcoded, 
-    This should only be used when the year doesn't matter in the output.
-    '''
-    pairs = []
-    # Note that we assume the dict's keys are month numbers in the correct order!
-    for k in [str(i) for i in list(range(1,13))]:
-        # Quick fix to convert our local time to UTC time
-        timestamp_local = calendar.timegm(datetime.datetime(2015, int(k), 2).timetuple())
-        timestamp_utc = datetime.datetime.utcfromtimestamp(timestamp_local)
-        pairs.append({'x': timestamp_utc.timestamp() * 1000, 'y':mydict[k]})
-    return pairs
+def solve_breakeven(savings, costs):
+    '''
+    Return a dict of break even times, in years, for a dict of costs, given a series of monthly savings. 
+    The savings are accumulated once and all costs are resolved with a single vectorized search. A cost that 
+    is not recovered within the length of the savings series has a break even time of None.
+    '''
+    keys = list(costs.keys())
+    # The running maximum makes the cumulative sum non-decreasing (and thus searchable) even if some months 
+    # have negative savings, without changing the first month in which each cost is recovered.
+    cum_savings = np.maximum.accumulate(np.cumsum(np.asarray(savings, dtype=float)))
+    months = np.searchsorted(cum_savings, [float(costs[k]) for k in keys], side='left')
+    # Add 1 to output because indices begin at 0
+    return {k: (m + 1) / 12 if m < len(cum_savings) else None for k, m in zip(keys, months.tolist())}
 
-def list_to_dict_pairs_x_dates(mylist):
-    '''
-    Helper function that's useful for NVD3: takes a list of arbitrary length that should 
-    represent some values of months starting in April 2015,
-    and return a list of dictionaries, each of which has 'x' and 'y' keys, where 
-    the 'x' key is also a UNIX timestamp in milliseconds.
-    Using integer division and modulo, it correctly generates future year-month pairs starting 
-    in April 2015.
-    '''
-    pairs = []
-    for i, v in enumerate(mylist):
-        #TODO: test this with other year and month values
-        year = 2015
-        month = 4
-        if i % 12 <= (12 - month) and not i <= 12 - month + 1:
-            months = i % 12 + month
-            years = i // 12 + year
-        else:
-            if i >= 9:
-                months = i % 12 + month - 12
-                years = i // 12 + year + 1            
-            else:
-                months = i + month
-                years = i // 12 + year
-        #print(years,months)
-        pairs.append({'x': datetime.datetime(years, months, 1).timestamp() * 1000, 'y': v})
-    return pairs
+@functools.lru_cache(maxsize=None)
+def month_axis():
+    '''
+    Return the NVD3 x values (UNIX timestamps in milliseconds) for months 1-12, computed once per process. 
+    Since the year is hardcoded, this should only be used when the year doesn't matter in the output. 
+    We use the 2nd of the month so that a time zone offset can't push a point into the previous month.
+    '''
+    return tuple(datetime.datetime(2015, month, 2).timestamp() * 1000 for month in range(1, 13))
+
+@functools.lru_cache(maxsize=None)
+def forecast_axis(periods=360):
+    '''
+    Return the NVD3 x values (UNIX timestamps in milliseconds) for periods months starting in April 2015, 
+    the first month of the price forecasts, computed once per process.
+    '''
+    return tuple(datetime.datetime(2015 + (i + 3) // 12, (i + 3) % 12 + 1, 1).timestamp() * 1000 for i in range(periods))
+
+def series_json(axis, series, columnar=False):
+    '''
+    Return the JSON for a graph, given its x axis (e.g. month_axis()) and a list of series, each a dict with 
+    'key', 'color' and 'values' (an array with one y value per x value). By default this is what NVD3 expects, 
+    a list of series whose values are lists of {'x', 'y'} dicts; with columnar, it's one shared x list and a 
+    y list per series, which is much smaller, and which canisolar.js expands on the client. 
+    Missing values (NaN) become null.
+    '''
+    columns = [[y if math.isfinite(y) else None for y in np.asarray(s['values'], dtype=float).tolist()] for s in series]
+    if columnar:
+        return json.dumps({'x': axis, 'series': [{'key': s['key'], 'color': s['color'], 'y': y} 
+                                                 for s, y in zip(series, columns)]})
+    return json.dumps([{'key': s['key'], 'color': s['color'], 'values': [{'x': x, 'y': v} for x, v in zip(axis, y)]} 
+                       for s, y in zip(series, columns)])
+
+class param(object):
+    '''
+    An input of a SolarUser. Setting it discards the values of the nodes that depend on it, directly or not.
+    '''
+    def __set_name__(self, owner, name):
+        self.name = name
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+        obj.invalidate(self.name)
+
+class node(param):
+    '''
+    A lazily computed attribute of a SolarUser: the decorated method is called the first time the attribute 
+    is read, and the value is kept until one of the params or nodes named in depends changes. A node can also 
+    be set, which overrides its value (and invalidates its own dependents).
+    '''
+    def __init__(self, *depends):
+        self.depends = depends
+    def __call__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+        return self
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if self.name not in obj.__dict__:
+            obj.__dict__[self.name] = self.func(obj)
+        return obj.__dict__[self.name]
 
 class SolarUser(object):
     '''
-    Currently, a new SolarUser should be instantiated if any of the input values change.
+    Inputs (lon, lat, state, cost, month, ann_demand_met, efficiency, net_metering, derate_factor) can be changed 
+    at any time. Outputs (req_cap, req_area_m2, req_area_sqft, install_cost, savings, breakeven and the graph 
+    series) are computed when first read, and only the ones that depend on a changed input are recomputed, 
+    so e.g. changing ann_demand_met doesn't fetch insolation, prices or consumption again.
     '''
+    lon = param()
+    lat = param()
+    state = param()
+    cost = param()
+    month = param()
+    ann_demand_met = param()
+    efficiency = param()
+    net_metering = param()
+    derate_factor = param()
     def __init__(self, lon, lat, state, cost, month, ann_demand_met=0.5, efficiency=0.15, net_metering=True):
         # Set up SolarUser instance variables
         self.lon = lon
@@ -103,39 +256,130 @@ class SolarUser(object):
         # This is currently a constant derating factor to account for system losses, e.g. DC to AC conversion, etc.
         # This value is obtained from http://rredc.nrel.gov/solar/calculators/pvwatts/version1/derate.cgi
         self.derate_factor = 0.77
+    @classmethod
+    def dependents(cls, name):
+        '''Return the names of all nodes that depend on name, directly or not.'''
+        if '_dependents' not in cls.__dict__:
+            direct = {}
+            for attr in dir(cls):
+                value = getattr(cls, attr)
+                if isinstance(value, node):
+                    for dependency in value.depends:
+                        direct.setdefault(dependency, []).append(attr)
+            cls._dependents = {}
+            for start in set(direct):
+                found, stack = set(), list(direct[start])
+                while stack:
+                    attr = stack.pop()
+                    if attr not in found:
+                        found.add(attr)
+                        stack.extend(direct.get(attr, []))
+                cls._dependents[start] = found
+        return cls._dependents.get(name, ())
+    def invalidate(self, name):
+        '''Discard the values of all nodes that depend on name.'''
+        for attr in self.dependents(name):
+            self.__dict__.pop(attr, None)
+    @node('lon', 'lat')
+    def insolation_doc(self):
+        '''The insolation polygon (or raster cell) containing the user's location.'''
+        # When there are multiple matching polygons, use the first one, like get_insolation.
+        return Insolation(get_insolation_index(), client=get_mongo_client()).poly_find(self.lon, self.lat)[0]
+    @node('insolation_doc')
+    def insolation(self):
+        '''Monthly insolation (kWh / m^2 / day) at the user's location, as a DataFrame indexed by month.'''
         # We don't need an Insolation instance after getting the insolation once, so don't save it
-        myInsolation = Insolation()
-        self.insolation = myInsolation.get_insolation(self.lon, self.lat)
-        # We don't need an EIA_DB instance after getting price and consumption data, so don't save it
-        myEIA_DB = EIA_DB(eia_db_url, eia_db_name)
-        self.prices = myEIA_DB.get_prices(self.state, periods=12)
+        return Insolation(get_insolation_index(), client=get_mongo_client()).doc_insolation(self.insolation_doc)
+    @node('state')
+    def prices(self):
+        '''The state's most recent 12 months of prices, as a DataFrame indexed by month.'''
+        # Prices and consumption come from the shared in-memory snapshot of the EIA tables
+        prices = eia_snapshot.get_prices(self.state, periods=12)
         # Since we don't care about the year of these prices, use just the month as the index
-        self.prices.index = self.prices.index.month
+        prices.index = prices.index.month
         # Sort so that months are in order
-        self.prices.sort_index(inplace=True)
-        self.consumption =  myEIA_DB.est_monthly_consump(self.month, self.cost, self.state)
-        self.annual_consumption = myEIA_DB.est_annual_consump(self.month, self.consumption, self.state)
-        self.total_consumption = self.annual_consumption['kWh'].sum()
+        prices.sort_index(inplace=True)
+        return prices
+    @node('month', 'cost', 'state')
+    def consumption(self):
+        '''Estimated consumption (kWh) in the month of the user's bill.'''
+        return eia_snapshot.est_monthly_consump(self.month, self.cost, self.state)
+    @node('month', 'consumption', 'state')
+    def annual_consumption(self):
+        '''Estimated consumption (kWh) in each month of a year, as a DataFrame indexed by month.'''
+        return eia_snapshot.est_annual_consump(self.month, self.consumption, self.state)
+    # The arithmetic is done on plain arrays (see core.py); the pandas objects above are kept for output
+    @node('insolation')
+    def insolation_array(self):
+        return self.insolation['kWhpm2'].values.astype(float)
+    @node('annual_consumption')
+    def consumption_array(self):
+        return self.annual_consumption['kWh'].values.astype(float)
+    @node('consumption_array')
+    def total_consumption(self):
+        return self.consumption_array.sum()
+    @node('state')
+    def prices_forecasted(self):
+        '''Forecasted prices (cents per kWh) for the next 360 months, as a read-only array.'''
+        # I only forecast out 30 years.
+        return np.asarray(myr.predict_prices(self.state, 360), dtype=float)
+    @node('net_metering', 'total_consumption', 'ann_demand_met', 'insolation_array', 'consumption_array', 'derate_factor')
+    def req_cap(self):
+        '''Required nominal capacity (kW).'''
+        if self.net_metering == True:
+            return self.get_req_cap_nominal()
+        # When net metering is False, we have to consider the maximum array capacity that does not reduce bills 
+        # below 0. But we also want to know what proportion of demand we were able to meet.
+        return self.get_req_cap_max()
+    @node('total_consumption', 'ann_demand_met', 'insolation_array', 'efficiency')
+    def req_area_m2(self):
+        return self.get_req_area_m2()
+    @node('req_area_m2')
+    def req_area_sqft(self):
+        return self.get_req_area_sqft()
+    @node('state', 'req_cap')
+    def install_cost(self):
+        return self.get_install_cost(self.req_cap)
+    @node('consumption_array', 'insolation_array', 'req_cap', 'derate_factor', 'prices_forecasted')
+    def savings(self):
+        '''Savings ($) in each of 360 months.'''
+        return self.est_savings()
+    @node('install_cost', 'savings')
+    def breakeven(self):
+        '''
+        Break even times for the install cost bounds. Savings don't depend on the install cost, so they are 
+        computed once and solved for all three cost bounds. A breakeven of None means that it lies beyond 
+        the 30 year prediction horizon.
+        '''
+        return self.est_breakevens_net(self.install_cost, self.savings)
+    @node('prices', 'annual_consumption')
+    def bills_before(self):
+        '''Expected bills ($) in each month of the first year without solar, for the first graph.'''
+        return self.prices['cpkWh'].mul(self.annual_consumption['kWh']).mul(0.01).reindex(range(1, 13)).values
+    @node('bills_before', 'prices', 'insolation_array', 'req_cap', 'derate_factor')
+    def bills_after(self):
+        '''Expected bills ($) in each month of the first year with solar, for the first graph.'''
+        # Important: future costs are 1 minus the proportion of demand met by solar!    
+        return self.bills_before - self.prices['cpkWh'].reindex(range(1, 13)).values * 0.01 * self.est_annual_prod()
+    @node('consumption_array', 'prices_forecasted')
+    def future_costs_before(self):
+        '''Electricity costs ($) in each of 360 months without solar.'''
+        return core.lifetime_costs(self.consumption_array, self.prices_forecasted)
+    @node('future_costs_before', 'savings', 'install_cost')
+    def future_costs_after(self):
+        '''Electricity costs ($) in each of 360 months with solar, plus the install cost in the first month.'''
+        future_costs_after = self.future_costs_before - self.savings
+        # Here we add the initial install cost to the initial item
+        # Don't forget to reduce the initial cost because of the 30% federal tax credit!
+        future_costs_after[0] = future_costs_after[0] + self.install_cost['fit'] * 0.70
+        return future_costs_after
     def populate(self):
         '''
-        Call the appropriate methods in the appropriate order to produce all the usable output of the object.
+        Compute all the usable output of the object now, rather than when it's first read.
         '''
-        if self.net_metering == True:
-            self.req_cap = self.get_req_cap_nominal()
-        else:
-            # When net metering is False, we have to consider the maximum array capacity that does not reduce bills 
-            # below 0. But we also want to know what proportion of demand we were able to meet.
-            self.req_cap = self.get_req_cap_max()
-        self.req_area_m2 = self.get_req_area_m2()
-        self.req_area_sqft = self.get_req_area_sqft()
-        self.install_cost = self.get_install_cost(self.req_cap)   
-        self.breakeven = {}
-        for k in ('fit', 'lwr', 'upr'):
-            try:
-                self.breakeven[k] = self.est_breakeven_net(self.req_cap, self.install_cost[k])
-            except PredictionBoundError:
-                # TODO: See if we can avoid using a sentinel value
-                self.breakeven[k] = -1
+        # req_cap comes first, since without net metering it may lower ann_demand_met
+        for name in ('req_cap', 'req_area_m2', 'req_area_sqft', 'install_cost', 'savings', 'breakeven'):
+            getattr(self, name)
     def get_req_area_m2(self):
         '''
         Return the required area (in m^2) of an installation that would meet the proportion of a SolarUser's 
@@ -144,7 +388,7 @@ class SolarUser(object):
         kwh_req_per_year = self.total_consumption * self.ann_demand_met
         print("kWH required per year:", kwh_req_per_year)
         # A 1 m^2 panel would produce this many kWh per year
-        kwh_prod_per_year_per_m2 = (self.insolation['kWhpm2'] * self.efficiency * np.array(month_lengths)).sum()
+        kwh_prod_per_year_per_m2 = core.solar_hours_per_year(self.insolation_array * self.efficiency)
         print("kWh produced by a 1 m^2 panel per year:", kwh_prod_per_year_per_m2)        
         # So we need this many m^2:
         m2 = kwh_req_per_year / kwh_prod_per_year_per_m2
@@ -167,10 +411,11 @@ class SolarUser(object):
         #annual_prod = user.insolation['kWhpm2'] * month_lengths
         #excess_prod = user.annual_consumption['kWh'] - annual_prod
         # First we want to know, given each month's insolation, which month produces the most energy.
-        month_of_highest_prod = (self.insolation['kWhpm2'] * month_lengths).idxmax()
-        highest_prod = (self.insolation['kWhpm2'] * month_lengths).max()
+        monthly_prod = self.insolation_array * core.month_lengths_array
+        month_of_highest_prod = monthly_prod.argmax()
+        highest_prod = monthly_prod[month_of_highest_prod]
         # Now we need to find the corresponding consumption for the user in that month
-        highest_consump = self.annual_consumption['kWh'][month_of_highest_prod]
+        highest_consump = self.consumption_array[month_of_highest_prod]
         # Now see what size array would be needed to offset this amounth of consumption, given the solar hours in that month
         max_cap_actual = highest_consump / highest_prod
         max_cap_nominal = max_cap_actual / self.derate_factor
@@ -197,7 +442,7 @@ class SolarUser(object):
         '''
         kwh_req_per_year = self.total_consumption * self.ann_demand_met
         print("kWH desired over the course of a year:", kwh_req_per_year)
-        solar_hours_per_year = (self.insolation['kWhpm2'] * np.array(month_lengths)).sum()
+        solar_hours_per_year = core.solar_hours_per_year(self.insolation_array)
         print("Solar hours available over the course of a year:", solar_hours_per_year)
         actual_kw_req = kwh_req_per_year / solar_hours_per_year
         print("True system size required (kW):", actual_kw_req)
@@ -221,129 +466,141 @@ class SolarUser(object):
         return cost
     def est_annual_prod(self):
         '''
-        Return an estimate of kWh per month produced by an array of a given actual capacity with specified insolation.
+        Return an array with an estimate of kWh per month produced by an array of a given actual capacity 
+        with specified insolation.
         '''
-        annual_prod = self.insolation['kWhpm2'] * month_lengths * self.get_req_cap_actual()
-        return annual_prod
+        return core.annual_prod(self.insolation_array, self.get_req_cap_actual())
     def est_lifetime_prod(self):
         '''
         Helper method for est_annual_prod that creates 30 years of estimates, derated by exponentiall decaying 
         performance loss over time.
         '''
-        lifetime_prod = pd.concat([self.est_annual_prod()]*30, ignore_index=True).mul(pd.Series(pv_perf_loss_array), axis='index')   
-        return lifetime_prod
+        return core.lifetime_prod(self.insolation_array, self.get_req_cap_actual())
     def est_savings(self):
         '''
-        Return an estimate of savings (in $) over the course of a year, given a proportion of annual demand met.
-        This method uses forecasted prices.
+        Return an array with an estimate of savings (in $) for each month over 30 years, given a proportion 
+        of annual demand met. This method uses forecasted prices.
         '''
-        # I only forecast out 30 years.
-        prices_forecasted = myr.predict_prices(self.state, 360)
-        # Convert the prices to a pandas data frome
-        prices_forecasted = pd.DataFrame(list(prices_forecasted), columns=["price"])
-        # Repeat this 12-month consumption series 30 times
-        future_consump = pd.concat([self.annual_consumption]*30, ignore_index=True)
-        # Divide by 100 to turn cpkWh into dollars per kWh; match on index
-        future_costs_before = future_consump.mul(prices_forecasted['price'] / 100, axis='index')
-        future_costs_before.columns = ['dollars']
-        future_production = self.est_lifetime_prod()
-        # Since prices are in cents, but we want figures in dollars, divide prices by 100
-        future_costs_after = future_costs_before['dollars'] - future_production * (prices_forecasted['price'] / 100)
-        savings = future_costs_before['dollars'] - future_costs_after
-        return savings
-    def est_breakeven_gross(self, cap, cost):
+        return core.savings(self.consumption_array, self.insolation_array, self.get_req_cap_actual(), self.prices_forecasted)
+    def est_breakeven_gross(self, cap, cost, savings=None):
         '''
         Return break even time, in years, for an install of a given capacity and cost. Uses forecasted prices.
+        Pass savings (the output of est_savings) to avoid recomputing them.
         '''
-        remaining_cost = cost
-        savings = self.est_savings()        
-        savings_list = savings.values.tolist()
-        # Iterate through the savings list by month, deducting that month's savings from the total until we break even
-        for m, val in enumerate(savings_list):
-            remaining_cost = remaining_cost - savings_list[m]
-            if remaining_cost <= 0:
-                # Add 1 to output because indices begin at 0
-                print("Breakeven (years):", (m + 1) / 12)
-                return (m + 1) / 12
-        if remaining_cost > 0:
+        if savings is None:
+            savings = self.est_savings()
+        breakeven = solve_breakeven(savings, {'cost': cost})['cost']
+        if breakeven is None:
             raise PredictionBoundError
-    def est_breakeven_net(self, cap, cost):
+        print("Breakeven (years):", breakeven)
+        return breakeven
+    def est_breakeven_net(self, cap, cost, savings=None):
         '''
         Helper method that calculates breakeven times while including the 30% federal tax credit.
         '''
         net_cost = cost * 0.70
         print("The next line reports the breakeven time while including the 30% federal tax credit.")
-        return self.est_breakeven_gross(cap, net_cost)
+        return self.est_breakeven_gross(cap, net_cost, savings)
+    def est_breakevens_net(self, costs, savings=None):
+        '''
+        Return a dict of break even times, in years, for a dict of install costs (e.g. the output of 
+        get_install_cost), including the 30% federal tax credit. The savings are computed (or passed) once 
+        for all costs. Costs that are not recovered within the savings horizon have a break even time of None.
+        '''
+        if savings is None:
+            savings = self.est_savings()
+        net_costs = {k: cost * 0.70 for k, cost in costs.items()}
+        breakeven = solve_breakeven(savings, net_costs)
+        print("Breakeven (years), including the 30% federal tax credit:", breakeven)
+        return breakeven
 
-def make_graphs(user, loc):
+def graph_series(user):
     '''
-    Return a dict with, inter alia, the JSON for two graphs.
+    Return a dict of the arrays and axis bounds that the two graphs plot, for a populated SolarUser. These 
+    don't depend on the user's locality, so they can be cached with the rest of the estimate.
     '''
     # The first graph plots insolation as a line, as well as two bar series representing expected 
     # monthly bills in the first year, one each for the solar and non-solar condition
-    bills_before = user.prices['cpkWh'].mul(user.annual_consumption['kWh']).mul(0.01)
-    bills_before.name = "bills_before"
-    # Important: future costs are 1 minus the proportion of demand met by solar!    
-    #bills_after = user.prices['cpkWh'].mul(user.annual_consumption['kWh']).mul(1 - user.ann_demand_met).mul(0.01)
-    bills_after = bills_before - user.prices['cpkWh'].mul(0.01) * user.est_annual_prod()
-    bills_after.name = "bills_after"
-    
-    graph1_y1_max = round(bills_before.max())
-    graph1_y1_min = 0 if bills_after.min() > 0 else round(bills_after.min())
-    graph1_y2_max = round(user.insolation.max()['kWhpm2'])
-    
-    # Here we create the Python objects that we will JSON serialize for the first graph
-    bills_before_list = dict_to_dict_pairs(json.loads(bills_before.to_json()))
-    bills_after_list = dict_to_dict_pairs(json.loads(bills_after.to_json()))
-    insolation_list = dict_to_dict_pairs(json.loads(user.insolation.to_json())['kWhpm2'])    
-    
-    dict1 = {'key': 'Bills before solar', 
-             'color': '#ccf', 
-             'values': bills_before_list}
-    dict2 = {'key': 'Bills after solar', 
-             'color': '#b2df8a', 
-             'values': bills_after_list}
-    # Because sometimes locality names have apostrophes or other characters that need escaping
-    dict3 = {'key': ''.join(['Solar hours in ', html.escape(loc['locality'], quote=True), 
-                             ', ', loc['state']]), 
-                             'color': '#333', 
-                             'values': insolation_list}    
-    graph1_data = [dict1, dict2, dict3]
-    # Don't indent the JSON we send: indent=4 causing "unterminated string literal" error in JS
-    graph1_json = json.dumps(graph1_data)
-    
+    bills_before = user.bills_before
+    bills_after = user.bills_after
+    insolation = user.insolation['kWhpm2'].reindex(range(1, 13)).values
     # The second graph plots the cumulative money spent over time for both the solar and non-solar condition, as lines.
-    future_price_list = list(myr.predict_prices(user.state, 360))
-    future_consump = pd.concat([user.annual_consumption['kWh']]*30, ignore_index=True)
-    future_costs_before = future_consump.mul(future_price_list).mul(0.01)
-    future_costs_before_cum_list = list(future_costs_before.cumsum().values)
-    future_costs_after = future_costs_before - user.est_savings()
-    # Here we add the initial install cost to the initial item
-    # Don't forget to reduce the initial cost because of the 30% federal tax credit!
-    future_costs_after.loc[0] = future_costs_after.loc[0] + user.install_cost['fit'] * 0.70
-    future_costs_after_cum_list = list(future_costs_after.cumsum().values)
+    # The forecasts and savings are the ones populate() already computed.
+    future_costs_before_cum = user.future_costs_before.cumsum()
+    return {'bills_before': bills_before, 
+            'bills_after': bills_after, 
+            'insolation': insolation, 
+            'future_costs_before_cum': future_costs_before_cum, 
+            'future_costs_after_cum': user.future_costs_after.cumsum(), 
+            'graph1_y1_max': round(np.nanmax(bills_before)), 
+            'graph1_y1_min': 0 if np.nanmin(bills_after) > 0 else round(np.nanmin(bills_after)), 
+            'graph1_y2_max': round(np.nanmax(insolation)), 
+            'graph2_y1_max': math.ceil(future_costs_before_cum.max())}
 
-    graph2_y1_max = math.ceil(max(future_costs_before_cum_list))
-    
-    future_costs_before_list = list_to_dict_pairs_x_dates(future_costs_before_cum_list)
-    future_costs_after_list = list_to_dict_pairs_x_dates(future_costs_after_cum_list)    
+def render_graphs(series, loc, columnar=None):
+    '''
+    Return a dict with, inter alia, the JSON for two graphs, given the output of graph_series. See series_json 
+    for columnar, which defaults to graph_columnar.
+    '''
+    columnar = graph_columnar if columnar is None else columnar
+    # Because sometimes locality names have apostrophes or other characters that need escaping
+    graph1_data = [{'key': 'Bills before solar', 'color': '#ccf', 'values': series['bills_before']}, 
+                   {'key': 'Bills after solar', 'color': '#b2df8a', 'values': series['bills_after']}, 
+                   {'key': ''.join(['Solar hours in ', html.escape(loc['locality'], quote=True), ', ', loc['state']]), 
+                    'color': '#333', 'values': series['insolation']}]
+    # Don't indent the JSON we send: indent=4 causing "unterminated string literal" error in JS
+    graph1_json = series_json(month_axis(), graph1_data, columnar)
     
-    dict1 = {'values': future_costs_before_list,
-             'key': 'Cumulative costs without solar',
-             'color': '#333'}
-    dict2 = {'values': future_costs_after_list,
-             'key': 'Cumulative costs with solar',
-             'color': '#b2df8a'}
-             
-    graph2_data = [dict1, dict2]
-    graph2_json = json.dumps(graph2_data)
+    graph2_data = [{'key': 'Cumulative costs without solar', 'color': '#333', 'values': series['future_costs_before_cum']}, 
+                   {'key': 'Cumulative costs with solar', 'color': '#b2df8a', 'values': series['future_costs_after_cum']}]
+    graph2_json = series_json(forecast_axis(len(series['future_costs_before_cum'])), graph2_data, columnar)
     
-    graph_dict = {'graph1_json': graph1_json, 'graph1_y1_max': graph1_y1_max, 
-                  'graph1_y1_min': graph1_y1_min,
-                  'graph1_y2_max': graph1_y2_max, 'graph2_json': graph2_json,
-                  'graph2_y1_max': graph2_y1_max}
+    graph_dict = {'graph1_json': graph1_json, 'graph1_y1_max': series['graph1_y1_max'], 
+                  'graph1_y1_min': series['graph1_y1_min'],
+                  'graph1_y2_max': series['graph1_y2_max'], 'graph2_json': graph2_json,
+                  'graph2_y1_max': series['graph2_y1_max']}
     return graph_dict
 
+def make_graphs(user, loc, columnar=None):
+    '''
+    Return a dict with, inter alia, the JSON for two graphs. See series_json for columnar, which defaults 
+    to graph_columnar.
+    '''
+    return render_graphs(graph_series(user), loc, columnar)
+
+def result_key(user):
+    '''
+    Return the inputs of a SolarUser that determine its estimate: the state, the insolation polygon (or raster 
+    cell) containing its location, the bill, the month, and the slider values. The values are used exactly as 
+    given, so that a cached estimate is always the one computed for them; parse_inputs in app/views.py rounds 
+    them to the form's precision beforehand, so that nearby inputs share a key. The key also holds the version 
+    of the state's EIA data, so that estimates made before new data was loaded for it are no longer used. 
+    Finding the polygon is the only lookup this does.
+    '''
+    return (user.state, eia_snapshot.state_version(user.state), str(user.insolation_doc['_id']), float(user.cost), 
+            user.month, float(user.ann_demand_met), float(user.efficiency), bool(user.net_metering))
+
+def estimate(user):
+    '''
+    Return a dict of the outputs of populate() and graph_series for a SolarUser. Results are cached by 
+    result_key, so a repeat of recent inputs skips the database and model work entirely.
+    '''
+    # The key only needs the insolation polygon, so a cache hit does no other lookups
+    key = result_key(user)
+    result = result_cache.get(key)
+    if result is None:
+        user.populate()
+        # ann_demand_met and efficiency are included, since populate() may adjust ann_demand_met
+        result = {'ann_demand_met': user.ann_demand_met, 
+                  'efficiency': user.efficiency, 
+                  'req_cap': user.req_cap, 
+                  'req_area_sqft': user.req_area_sqft, 
+                  'install_cost': user.install_cost, 
+                  'breakeven': user.breakeven, 
+                  'graphs': graph_series(user)}
+        result_cache.put(key, result)
+    return result
+
 def main():
     pass
 
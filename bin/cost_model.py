@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:29:43 2026
+
+@author: gjm
+
+This file defines the CostModel class, which re-estimates the install cost model in Python.
+
+The model is the one fit by openpv_analysis.R, mod_fe_state_year:
+
+    lm(log(cost) ~ log(size) + state + year_installed)
+
+An OLS fit only depends on the data through X'X, X'y, y'y and n, so CostModel keeps those
+running sums and adds each new batch of installs to them, without rescanning the table. Sums
+can't take back rows they no longer know, so if any installs that were already added are
+deleted (as load_csv does when it reloads a file), the statistics are rebuilt from scratch.
+The sums are kept for a full set of state and year dummies, which can grow as new levels
+appear; fitting picks out R's treatment-coded columns (the first level of each factor, in
+sorted order, is the baseline), so the coefficients, covariance matrix and 90% prediction
+intervals are those R would compute on the same installs. fit() returns them in the form
+that portable.py exports, and write_artifact swaps them into a PortableR archive:
+
+    python cost_model.py ../models/cost_model_stats.npz --artifact ../models/canisolar_models.npz
+"""
+
+from contextlib import contextmanager
+import argparse
+import json
+import os
+import numpy as np
+
+def t_quantile_95(df):
+    '''
+    Return the 95th percentile of the t distribution with df degrees of freedom (the multiplier of a 90%
+    prediction interval), by the Cornish-Fisher expansion around the normal quantile. This agrees with R's
+    qt(0.95, df) to better than 1e-8 for df >= 30, and the cost model has hundreds of thousands.
+    '''
+    z = 1.6448536269514722
+    g = ((z**3 + z) / 4,
+         (5 * z**5 + 16 * z**3 + 3 * z) / 96,
+         (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / 384,
+         (79 * z**9 + 776 * z**7 + 1482 * z**5 - 1920 * z**3 - 945 * z) / 92160)
+    return z + sum(gi / df**(i + 1) for i, gi in enumerate(g))
+
+class CostModel(object):
+    '''
+    Running sufficient statistics for the install cost model. Start empty, or load saved statistics with
+    CostModel.load, then call update with DataFrames of installs as they arrive.
+    '''
+    def __init__(self):
+        self.reset()
+    def reset(self):
+        '''Forget all the installs added so far.'''
+        self.states = []
+        self.years = []
+        self.xtx = np.zeros((2, 2))
+        self.xty = np.zeros(2)
+        self.yty = 0.0
+        self.n = 0
+        # The highest install id seen, so that updates from the database only read newer installs
+        self.max_install_id = 0
+        # The number of rows in the installs table with ids up to max_install_id, as of the last update_from_db. 
+        # If it drops, installs we've added were deleted. None means unknown, which forces a rebuild.
+        self.installs_below = 0
+    def columns(self):
+        '''Return the names of the columns the statistics are kept for, in R's naming.'''
+        return (['(Intercept)', 'log(size)'] + ['state' + state for state in self.states] +
+                ['year_installed' + year for year in self.years])
+    def add_levels(self, states, years):
+        '''Add columns (of zeros) to the statistics for states and years that haven't been seen before.'''
+        new_states = sorted(set(states) - set(self.states))
+        new_years = sorted(set(years) - set(self.years))
+        if not new_states and not new_years:
+            return
+        old = 2 + len(self.states) + len(self.years)
+        # Old columns keep their values, just shifted to make room for new state columns before the years
+        index = (list(range(2 + len(self.states))) +
+                 list(range(2 + len(self.states) + len(new_states), 2 + len(self.states) + len(new_states) + len(self.years))))
+        self.states += new_states
+        self.years += new_years
+        size = 2 + len(self.states) + len(self.years)
+        xtx = np.zeros((size, size))
+        xty = np.zeros(size)
+        xtx[np.ix_(index, index)] = self.xtx[:old, :old]
+        xty[index] = self.xty[:old]
+        self.xtx, self.xty = xtx, xty
+    def prepare(self, installs):
+        '''
+        Apply the same subset as openpv_analysis.R to a DataFrame of installs (as returned by OpenPV.get_installs),
+        and return the states, years (as strings), log sizes and log costs of those that remain.
+        '''
+        cost = installs['cost'].values.astype(float)
+        size = installs['size'].values.astype(float)
+        years = np.array([str(date.year) if hasattr(date, 'year') else '' for date in installs['date_installed']])
+        states = installs['state'].fillna('').values.astype(str)
+        # Outliers which are not going to be representative of residential installs, and anything na.omit would drop
+        keep = (cost > 1000) & (cost < 1000000) & (size > 0) & (years != '') & (states != '')
+        return states[keep], years[keep], np.log(size[keep]), np.log(cost[keep])
+    def update(self, installs):
+        '''Add a DataFrame of installs to the statistics. Costs O(len(installs)), however much has been seen.'''
+        if len(installs) == 0:
+            return
+        self.max_install_id = max(self.max_install_id, int(installs['id'].max()))
+        states, years, log_size, log_cost = self.prepare(installs)
+        self.add_levels(states, years)
+        state_index = {state: i for i, state in enumerate(self.states)}
+        year_index = {year: i for i, year in enumerate(self.years)}
+        X = np.zeros((len(log_cost), len(self.xty)))
+        rows = np.arange(len(log_cost))
+        X[:, 0] = 1.0
+        X[:, 1] = log_size
+        X[rows, [2 + state_index[state] for state in states]] = 1.0
+        X[rows, [2 + len(self.states) + year_index[year] for year in years]] = 1.0
+        self.xtx += X.T.dot(X)
+        self.xty += X.T.dot(log_cost)
+        self.yty += log_cost.dot(log_cost)
+        self.n += len(log_cost)
+    def update_from_db(self, openpv, chunksize=50000):
+        '''
+        Add the installs in the database that haven't been seen yet, reading only those, and return how many. If 
+        installs that were already added have since been deleted, rebuild the statistics from all installs instead.
+        '''
+        if self.max_install_id and openpv.count_installs(self.max_install_id) != self.installs_below:
+            print("Installs were deleted or reloaded since the last update; rebuilding the cost model statistics.")
+            self.reset()
+        count = 0
+        for chunk in openpv.iter_installs(chunksize=chunksize, since_id=self.max_install_id):
+            self.update(chunk)
+            count += len(chunk)
+        self.installs_below = openpv.count_installs(self.max_install_id)
+        return count
+    def fit(self):
+        '''
+        Solve for the coefficients, and return a dict with the same entries as the cost model part of a
+        portable.py archive: coef_names, coef, vcov, sigma, df, t_crit and cost_states.
+        '''
+        if not self.states:
+            raise ValueError("No installs have been added to the cost model yet.")
+        names = self.columns()
+        # Treatment coding: drop the dummy for the first level of each factor
+        baselines = ('state' + min(self.states), 'year_installed' + min(self.years))
+        keep = [i for i, name in enumerate(names) if name not in baselines]
+        xtx = self.xtx[np.ix_(keep, keep)]
+        xty = self.xty[keep]
+        xtx_inv = np.linalg.inv(xtx)
+        coef = xtx_inv.dot(xty)
+        df = self.n - len(keep)
+        if df <= 0:
+            raise ValueError("Need more than {} installs to fit the cost model, but have {}.".format(len(keep), self.n))
+        sigma2 = (self.yty - coef.dot(xty)) / df
+        return {'coef_names': [names[i] for i in keep],
+                'coef': coef,
+                'vcov': sigma2 * xtx_inv,
+                'sigma': float(np.sqrt(sigma2)),
+                'df': int(df),
+                't_crit': t_quantile_95(df),
+                'cost_states': sorted(self.states)}
+    def save(self, path):
+        '''Save the statistics to path, as a NumPy archive. The file is replaced whole, never written in place.'''
+        if not path.endswith('.npz'):
+            path = path + '.npz'
+        with replacing(path) as f:
+            # -1 stands for an unknown installs_below
+            installs_below = self.installs_below if self.installs_below is not None else -1
+            np.savez(f, states=np.array(self.states, dtype=str), years=np.array(self.years, dtype=str), xtx=self.xtx,
+                     xty=self.xty, scalars=np.array([self.yty, self.n, self.max_install_id, installs_below], dtype=float))
+    @classmethod
+    def load(cls, path):
+        '''Load statistics saved by save.'''
+        model = cls()
+        with np.load(path) as stats:
+            model.states = [str(state) for state in stats['states']]
+            model.years = [str(year) for year in stats['years']]
+            model.xtx = stats['xtx']
+            model.xty = stats['xty']
+            scalars = stats['scalars']
+        model.yty, model.n, model.max_install_id = float(scalars[0]), int(scalars[1]), int(scalars[2])
+        # Statistics saved without the row count can't be checked for deleted installs
+        model.installs_below = int(scalars[3]) if len(scalars) > 3 and scalars[3] >= 0 else None
+        return model
+
+@contextmanager
+def replacing(path):
+    '''
+    Open a temporary file next to path for writing (in binary), and move it over path once the body of the with 
+    statement succeeds, so that a process reading path sees either the old file or the new one, never half of one.
+    '''
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            yield f
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def write_artifact(model, path):
+    '''
+    Replace the cost model in a portable.py archive at path with a fresh fit of model, keeping its price
+    forecasts. The web app loads the archive once per process, so it only uses the new model once it is
+    restarted (e.g. with uwsgi --reload).
+    '''
+    from portable import PortableR
+    fitted = model.fit()
+    with np.load(path) as artifact:
+        meta = json.loads(str(artifact['meta']))
+        forecasts = artifact['forecasts']
+    if 'year_installed' + meta['year'] not in fitted['coef_names'] and meta['year'] != min(model.years):
+        raise ValueError("The archive predicts costs for {}, which has no installs.".format(meta['year']))
+    meta.update({k: fitted[k] for k in ('coef_names', 'sigma', 'df', 't_crit', 'cost_states')})
+    with replacing(path) as f:
+        np.savez_compressed(f, meta=np.array(json.dumps(meta)), forecasts=forecasts, coef=fitted['coef'], vcov=fitted['vcov'])
+    return PortableR(path)
+
+def main():
+    from openpv import OpenPV, db_url, db_name
+    parser = argparse.ArgumentParser(description="Update the install cost model with new installs.")
+    parser.add_argument('stats_path', help="where the running statistics are kept, e.g. cost_model_stats.npz")
+    parser.add_argument('--artifact', help="portable.py archive to write the refreshed cost model into")
+    args = parser.parse_args()
+    model = CostModel.load(args.stats_path) if os.path.exists(args.stats_path) else CostModel()
+    openpv = OpenPV(db_url, db_name)
+    added = model.update_from_db(openpv)
+    openpv.close()
+    model.save(args.stats_path)
+    fitted = model.fit()
+    print("Added {} installs; fit on {} installs, {} states and {} years (residual standard error {:.4f})".format(
+          added, model.n, len(model.states), len(model.years), fitted['sigma']))
+    if args.artifact:
+        write_artifact(model, args.artifact)
+        print("Wrote the cost model to", args.artifact, "(restart the web app to use it)")
+
+if __name__ == "__main__":
+    main()
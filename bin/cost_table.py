@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:16:37 2026
+
+@author: gjm
+
+This file defines the CostTable class, a precomputed per-state install cost surface.
+
+The install cost model (mod_fe_state_year) is linear in log(size), so instead of evaluating
+it on every request, we evaluate the fit, lwr and upr curves for every state once, on a
+dense log-spaced capacity grid, and save them as a compact binary table. Lookups interpolate
+log(cost) linearly in log(size), which is exact for the point estimate and very close for the
+prediction interval bounds. Building the table measures its error against the model and stores
+it in the table; CostTable refuses a table whose error exceeds its bound. The web app uses the
+table in place of the model's cost predictions when canisolar.cost_backend is "table".
+Run this file to build the table and report its error, against R or a portable.py archive:
+
+    python cost_table.py ../models/ ../models/cost_table.npz
+    python cost_table.py ../models/canisolar_models.npz ../models/cost_table.npz
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+
+bounds = ('fit', 'lwr', 'upr')
+# The largest relative error against the model that a table may have, for any bound
+default_max_error = 1e-3
+
+def build_cost_table(myr, path, min_size=0.1, max_size=100.0, points=512):
+    '''
+    Evaluate the cost model for every state on a grid of points sizes (in kW) between min_size and max_size,
+    and save the log costs to path as a compressed NumPy archive, along with the table's maximum relative error
+    against the model for each bound. myr is an R, PortableR or CachedR instance. Returns the archive's path.
+    '''
+    states = sorted(myr.cost_states())
+    sizes = np.geomspace(min_size, max_size, points)
+    log_costs = np.empty((len(states), len(bounds), points), dtype=np.float32)
+    for i, state in enumerate(states):
+        cost = myr.predict_costs(state, sizes)
+        for j, k in enumerate(bounds):
+            log_costs[i, j] = np.log(cost[k])
+    # NumPy adds the extension if it's missing, so make sure we load the file it actually writes
+    if not path.endswith('.npz'):
+        path = path + '.npz'
+    error = check_cost_table(CostTable.from_arrays(states, np.log(sizes), log_costs), myr)
+    np.savez_compressed(path, states=np.array(states), log_sizes=np.log(sizes), log_costs=log_costs,
+                        max_error=np.array([error[k] for k in bounds]))
+    return path
+
+class CostTable(object):
+    '''
+    Load a table made by build_cost_table, and provide the same prediction interface as R: costs come from the
+    table, and everything else (price forecasts, load_models) from model, e.g. a PortableR. Raises ValueError
+    if the table's recorded error against the model exceeds max_error.
+    '''
+    def __init__(self, path, model=None, max_error=default_max_error):
+        self.path = path
+        self.model = model
+        self.max_error = max_error
+        self.load_table()
+    @classmethod
+    def from_arrays(cls, states, log_sizes, log_costs):
+        '''Return a CostTable over arrays that haven't been saved yet, without a model or error bound.'''
+        table = cls.__new__(cls)
+        table.path, table.model, table.max_error = None, None, None
+        table.set_arrays(states, log_sizes, log_costs)
+        return table
+    def load_table(self):
+        '''(Re)load the table at path, and check its recorded error.'''
+        with np.load(self.path) as table:
+            states = [str(state) for state in table['states']]
+            log_sizes = table['log_sizes']
+            log_costs = table['log_costs']
+            error = dict(zip(bounds, table['max_error'].tolist()))
+        worst = max(error.values())
+        if self.max_error is not None and not worst <= self.max_error:
+            raise ValueError("Cost table {} has a relative error of {:.2e}, more than {:.2e}; rebuild it.".format(
+                self.path, worst, self.max_error))
+        self.error = error
+        self.set_arrays(states, log_sizes, log_costs)
+    def set_arrays(self, states, log_sizes, log_costs):
+        self.states = list(states)
+        self.log_sizes = log_sizes
+        self.log_costs = np.asarray(log_costs, dtype=float)
+        self.state_index = {state: i for i, state in enumerate(self.states)}
+        # Slopes of the first and last grid segments, used to extrapolate beyond the grid
+        self.slope_lo = (self.log_costs[:, :, 1] - self.log_costs[:, :, 0]) / (self.log_sizes[1] - self.log_sizes[0])
+        self.slope_hi = (self.log_costs[:, :, -1] - self.log_costs[:, :, -2]) / (self.log_sizes[-1] - self.log_sizes[-2])
+    def load_models(self):
+        '''
+        Reload the model and the table, e.g. from CachedR.reload().
+        '''
+        if self.model is not None:
+            self.model.load_models()
+        self.load_table()
+    def cost_states(self):
+        '''
+        Return a list of the states in the table.
+        '''
+        return list(self.states)
+    def predict_costs(self, state, sizes):
+        '''
+        Return a cost dict of numpy arrays with the point estimates and 90% prediction interval bounds,
+        one element per size in sizes. Raises KeyError for states that the model was not fit on.
+        '''
+        i = self.state_index[state]
+        x = np.log(np.asarray(sizes, dtype=float))
+        cost = {}
+        for j, k in enumerate(bounds):
+            y = np.interp(x, self.log_sizes, self.log_costs[i, j])
+            y = np.where(x < self.log_sizes[0], self.log_costs[i, j, 0] + self.slope_lo[i, j] * (x - self.log_sizes[0]), y)
+            y = np.where(x > self.log_sizes[-1], self.log_costs[i, j, -1] + self.slope_hi[i, j] * (x - self.log_sizes[-1]), y)
+            cost[k] = np.exp(y)
+        return cost
+    def predict_cost(self, state, size):
+        '''
+        Return a cost dict with the point estimate and 90% prediction interval bounds for a single size.
+        '''
+        cost = self.predict_costs(state, [size])
+        return {k: float(cost[k][0]) for k in bounds}
+    def predict_prices(self, state, periods):
+        '''
+        Return forecasted prices from the model, which the table doesn't hold.
+        '''
+        return self.model.predict_prices(state, periods)
+
+def check_cost_table(table, myr, points=64):
+    '''
+    Compare the table against the model at the midpoints between grid nodes (where linear interpolation
+    error is largest), and return the maximum relative error for each bound.
+    '''
+    # Spread the checks over the whole grid
+    nodes = np.linspace(0, len(table.log_sizes) - 2, points).astype(int)
+    sizes = np.exp((table.log_sizes[nodes] + table.log_sizes[nodes + 1]) / 2)
+    max_error = {k: 0.0 for k in bounds}
+    for state in table.states:
+        expected = myr.predict_costs(state, sizes)
+        actual = table.predict_costs(state, sizes)
+        for k in bounds:
+            error = np.abs(actual[k] - expected[k]) / expected[k]
+            max_error[k] = max(max_error[k], float(error.max()))
+    return max_error
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the precomputed install cost table.")
+    parser.add_argument('model_path', help="directory holding the R model objects, or a portable.py archive")
+    parser.add_argument('table_path', help="where to write the table, e.g. cost_table.npz")
+    parser.add_argument('--min-size', type=float, default=0.1, help="smallest capacity in the grid (kW)")
+    parser.add_argument('--max-size', type=float, default=100.0, help="largest capacity in the grid (kW)")
+    parser.add_argument('--points', type=int, default=512, help="number of grid points")
+    parser.add_argument('--max-error', type=float, default=default_max_error, help="largest relative error allowed")
+    args = parser.parse_args()
+    if os.path.isfile(args.model_path):
+        from portable import PortableR
+        myr = PortableR(args.model_path)
+    else:
+        from r import R
+        myr = R(args.model_path)
+    path = build_cost_table(myr, args.table_path, args.min_size, args.max_size, args.points)
+    table = CostTable(path, myr, max_error=None)
+    print("Built cost table for", len(table.states), "states and", len(table.log_sizes), "sizes:", path)
+    for k in bounds:
+        print("Maximum relative interpolation error ({}): {:.2e}".format(k, table.error[k]))
+    if max(table.error.values()) > args.max_error:
+        print("The error exceeds {:.2e}, so the web app will refuse this table; use more --points.".format(args.max_error))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:21:35 2026
+
+@author: gjm
+
+This file defines the shared database connection layer used on the request path.
+
+MySQLPool is a bounded pool of pymysql connections, which are health checked when they are
+checked out and reconnected if they've gone away. get_mongo_client returns one pymongo client
+(which pools its own sockets) per process. Both are fork-safe: uWSGI forks its workers from the
+master, and a connection inherited across a fork shares its socket with the parent, so each
+process notices that its pid has changed and starts over with its own connections.
+
+Creating the databases and tables is no longer done on the request path; run this file once at
+deploy time instead:
+
+    python db.py --bootstrap
+"""
+
+from contextlib import contextmanager
+import argparse
+import os
+import queue
+import threading
+import time
+import pymongo
+import pymongo.errors
+import pymysql
+
+# Seconds that any one call to MySQL or MongoDB on the request path may take: connecting, and waiting for each 
+# read or write. A stalled database then fails the request quickly, rather than holding the worker.
+backend_timeout = 5.0
+
+class PoolTimeoutError(RuntimeError):
+    '''
+    Designed to be raised when no pooled connection becomes available in time.
+    '''
+    pass
+
+class MySQLPool(object):
+    '''
+    A bounded pool of at most maxsize connections to the db_name database on db_url. Connections are opened
+    on demand, and checked with a ping if they have been idle for more than ping_after seconds.
+    '''
+    def __init__(self, db_url, db_name, maxsize=5, timeout=10.0, ping_after=30.0):
+        self.db_url = db_url
+        self.db_name = db_name
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        '''Forget all connections, e.g. after a fork. They are not closed, since the parent may still use them.'''
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.maxsize)
+        self.counts = {'created': 0, 'checkouts': 0, 'waits': 0, 'reconnects': 0, 'in_use': 0}
+    def count(self, name, n=1):
+        '''Add n to one of the statistics counters, which threads share.'''
+        with self.lock:
+            self.counts[name] += n
+    def connect(self):
+        '''Open a new connection.'''
+        self.count('created')
+        # charset utf8mb4 is the only proper way to handle true UTF-8 in mySQL.
+        # autocommit, so that a pooled connection never holds on to an old transaction snapshot
+        return pymysql.connect(host=self.db_url,
+            user='root',
+            passwd='',
+            db=self.db_name,
+            charset='utf8mb4',
+            autocommit=True,
+            connect_timeout=backend_timeout,
+            read_timeout=backend_timeout,
+            write_timeout=backend_timeout,
+            cursorclass=pymysql.cursors.Cursor)
+    def check_fork(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+    @contextmanager
+    def connection(self):
+        '''
+        Check out a connection for the body of the with statement, waiting up to timeout seconds for one.
+        '''
+        self.check_fork()
+        if not self.slots.acquire(blocking=False):
+            self.count('waits')
+            if not self.slots.acquire(timeout=self.timeout):
+                raise PoolTimeoutError("No MySQL connection available after {} seconds.".format(self.timeout))
+        try:
+            try:
+                connection, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                connection, last_used = self.connect(), time.time()
+            if time.time() - last_used > self.ping_after:
+                try:
+                    connection.ping(reconnect=False)
+                except pymysql.err.Error:
+                    self.count('reconnects')
+                    connection = self.connect()
+            self.count('checkouts')
+            self.count('in_use')
+            try:
+                yield connection
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+                # The connection may be broken (or closed, which raises InterfaceError); don't hand it out again
+                connection = None
+                raise
+            finally:
+                self.count('in_use', -1)
+                if connection is not None and self.pid == os.getpid():
+                    self.idle.put((connection, time.time()))
+        finally:
+            self.slots.release()
+    def stats(self):
+        '''Return a dict of pool statistics.'''
+        with self.lock:
+            stats = dict(self.counts)
+        stats.update({'idle': self.idle.qsize(), 'maxsize': self.maxsize})
+        return stats
+
+# One pool per (db_url, db_name) and one Mongo client per process
+mysql_pools = {}
+mongo_client = {'pid': None, 'client': None, 'created': 0}
+pools_lock = threading.Lock()
+
+def get_mysql_pool(db_url, db_name, maxsize=5):
+    '''Return the shared pool for the db_name database on db_url, creating it if necessary.'''
+    with pools_lock:
+        if (db_url, db_name) not in mysql_pools:
+            mysql_pools[(db_url, db_name)] = MySQLPool(db_url, db_name, maxsize)
+        return mysql_pools[(db_url, db_name)]
+
+def get_mongo_client(maxsize=10):
+    '''Return this process's MongoDB client, creating a new one if there is none yet or we've been forked.'''
+    with pools_lock:
+        if mongo_client['pid'] != os.getpid():
+            # connect=False defers connecting until the first operation, which keeps this safe to call before a fork
+            timeout_ms = int(backend_timeout * 1000)
+            mongo_client['client'] = pymongo.MongoClient(maxPoolSize=maxsize, connect=False, connectTimeoutMS=timeout_ms,
+                                                         socketTimeoutMS=timeout_ms, serverSelectionTimeoutMS=timeout_ms)
+            mongo_client['pid'] = os.getpid()
+            mongo_client['created'] += 1
+        return mongo_client['client']
+
+# What the request path raises when a database is down or doesn't answer within backend_timeout
+backend_errors = (PoolTimeoutError, pymysql.err.OperationalError, pymongo.errors.PyMongoError)
+
+def stats():
+    '''Return statistics for all the MySQL pools, and the number of Mongo clients created.'''
+    return {'mysql': {'/'.join(key): pool.stats() for key, pool in mysql_pools.items()},
+            'mongo': {'clients_created': mongo_client['created']}}
+
+def bootstrap(eia_db_url="localhost", eia_db_name="eia"):
+    '''Create (or migrate) the EIA database and tables, and create the insolation index.'''
+    from eia import EIA_DB
+    from insolation import Insolation
+    # Without a connection passed in, EIA_DB creates the database and tables itself
+    eia_db = EIA_DB(eia_db_url, eia_db_name)
+    # Tables created by older versions lack the unique and covering indexes
+    eia_db.migrate()
+    eia_db.close()
+    Insolation().poly_index()
+
+def main():
+    parser = argparse.ArgumentParser(description="Database setup for deployment.")
+    parser.add_argument('--bootstrap', action='store_true', help="create or migrate the databases, tables and indexes")
+    args = parser.parse_args()
+    if args.bootstrap:
+        bootstrap()
+        print("Schema bootstrap complete.")
+
+if __name__ == "__main__":
+    main()
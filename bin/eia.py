@@ -4,32 +4,44 @@ Created on Tue Jun  2 16:24:14 2015
 
 @author: gjm
 
-This file defines two classes: EIA_DB, and EIA_API.
+This file defines three classes: EIA_DB, EIA_Snapshot, and EIA_API.
 
 EIA_DB is used for retrieval of Energy Information Administration 
 data, which is stored in MySQL tables.
 
+EIA_Snapshot holds all of those tables in memory, and serves the same reads 
+as EIA_DB without querying MySQL on every request.
+
 EIA_API defines a class that was used to retrieve this information from the EIA 
-in the first place. It is not used in normal program flow, although it may be used 
-at some point in the future if I implement automatic updating of the database 
-with new prices.
+in the first place. It is not used in normal program flow, but EIA_API.sync 
+keeps the database up to date incrementally, fetching only the series that the 
+EIA's updates endpoint reports as changed.
 """
 
-import requests
+import threading
+import time
+import numpy as np
 import pandas as pd
 import pymysql
+from db import get_mysql_pool
+from harvest import HTTPClient, eia_limiter
 
 mysql_url = "localhost"
 mysql_db = "eia"
 
 class EIA_DB(object):
     """This class defines methods for interacting with the EIA MySQL tables."""
-    def __init__(self, db_url, db_name):
+    def __init__(self, db_url, db_name, connection=None):
         """Instantiate an EIA_DB object.
-        Create a database and tables if necessary.
+        Pass a connection (e.g. one checked out from a db.MySQLPool) to use it as is; 
+        otherwise, connect, and create a database and tables if necessary.
         """
         self.db_url = db_url
         self.db_name = db_name
+        if connection is not None:
+            # The schema is created at deploy time (see db.py), not on the request path
+            self.connection = connection
+            return
         # charset utf8mb4 is the only proper way to handle true UTF-8 in mySQL.
         # First open connection to server without specifying db
         self.connection = pymysql.connect(host=self.db_url,
@@ -59,24 +71,115 @@ class EIA_DB(object):
         self.connection.commit()        
     def create_tables(self):     
         """Create MySQL tables if they don't already exist.""" 
+        # One row per state and month, so that loading is idempotent; the second index covers 
+        # the WHERE state = ... ORDER BY date DESC LIMIT ... queries (see also migrate())
         prices = '''CREATE TABLE IF NOT EXISTS retail_residential_prices (
             id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, 
             state CHAR(2),
             date DATE,
-            price FLOAT
+            price FLOAT,
+            UNIQUE KEY state_date (state, date),
+            KEY state_date_covering (state, date, price, id)
             )
             ENGINE=MyISAM'''
         consump = '''CREATE TABLE IF NOT EXISTS retail_residential_sales (
             id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, 
             state CHAR(2),
             date DATE,
-            sales FLOAT
+            sales FLOAT,
+            UNIQUE KEY state_date (state, date),
+            KEY state_date_covering (state, date, sales, id)
+            )
+            ENGINE=MyISAM'''
+        # One version per state, bumped whenever either table's rows for that state are written, so that 
+        # every EIA_Snapshot (one per web worker) can tell which states to reload
+        versions = '''CREATE TABLE IF NOT EXISTS state_versions (
+            state CHAR(2) NOT NULL PRIMARY KEY,
+            version INT UNSIGNED NOT NULL
             )
             ENGINE=MyISAM'''
         with self.connection.cursor() as cursor:
-            for sql in (prices, consump):
+            for sql in (prices, consump, versions):
                 cursor.execute(sql)
         self.connection.commit()        
+    def migrate(self):
+        """Bring tables created before the unique and covering indexes existed up to date. 
+        Duplicate (state, date) rows are removed first, keeping the most recently inserted one. 
+        States that have rows but no version yet get version 1. Safe to run more than once.
+        """
+        for table, column in (('retail_residential_prices', 'price'), ('retail_residential_sales', 'sales')):
+            with self.connection.cursor() as cursor:
+                cursor.execute('''SELECT INDEX_NAME FROM information_schema.STATISTICS 
+                    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s''', (self.db_name, table))
+                indexes = set(row[0] for row in cursor.fetchall())
+                if 'state_date' not in indexes:
+                    deleted = cursor.execute('''DELETE older FROM {t} older JOIN {t} newer 
+                        ON older.state = newer.state AND older.date = newer.date AND older.id < newer.id'''.format(t=table))
+                    print("Removed", deleted, "duplicate rows from", table)
+                    cursor.execute('''ALTER TABLE {} ADD UNIQUE KEY state_date (state, date)'''.format(table))
+                if 'state_date_covering' not in indexes:
+                    cursor.execute('''ALTER TABLE {} ADD KEY state_date_covering (state, date, {}, id)'''.format(table, column))
+                cursor.execute('''INSERT IGNORE INTO state_versions (state, version) 
+                    SELECT DISTINCT state, 1 FROM {} WHERE state IS NOT NULL'''.format(table))
+            self.connection.commit()
+    def upsert_rows(self, table, column, rows, batch_size=1000):
+        """Insert or update (state, date, value) rows in a table, where date is a 'YYYY-MM' string, using 
+        multi-row INSERT ... ON DUPLICATE KEY UPDATE statements of batch_size rows each. rows may be any 
+        iterable (e.g. a generator), and is consumed as it goes. The version of every state loaded is 
+        bumped along with each batch (see bump_versions). Return the number of rows loaded.
+        """
+        # pymysql rewrites executemany of a plain VALUES (%s, ...) clause into one multi-row INSERT, 
+        # so the date is converted here rather than with STR_TO_DATE
+        sql = '''INSERT INTO {table} (state, date, {column}) VALUES (%s, %s, %s) 
+            ON DUPLICATE KEY UPDATE {column} = VALUES({column})'''.format(table=table, column=column)
+        start = time.time()
+        count = 0
+        batch = []
+        for state, date, value in rows:
+            # if a variable is missing, it's an empty string; set that to None instead so that it becomes NULL in the db
+            # we add the -01 to avoid illegal date strings that have day 00 in MySQL
+            batch.append((state if state != '' else None, 
+                          date + '-01' if date != '' else None, 
+                          value if value != '' else None))
+            if len(batch) >= batch_size:
+                count += self.execute_batch(sql, batch)
+                self.bump_versions(set(row[0] for row in batch))
+                batch = []
+        if batch:
+            count += self.execute_batch(sql, batch)
+            self.bump_versions(set(row[0] for row in batch))
+        elapsed = time.time() - start
+        print("Loaded {} rows into {} in {:.2f} s ({:.0f} rows/sec)".format(count, table, elapsed, 
+              count / elapsed if elapsed > 0 else float('inf')))
+        return count
+    def execute_batch(self, sql, batch):
+        """Execute sql for every row in batch, and commit once."""
+        with self.connection.cursor() as cursor:
+            cursor.executemany(sql, batch)
+        self.connection.commit()
+        return len(batch)
+    def bump_versions(self, states):
+        """Increment the version of each of states in state_versions (starting new states at 1), which tells 
+        every EIA_Snapshot to reload them, and cached estimates for them to be recomputed.
+        """
+        states = sorted(state for state in states if state is not None)
+        if not states:
+            return
+        with self.connection.cursor() as cursor:
+            cursor.executemany('''INSERT INTO state_versions (state, version) VALUES (%s, 1) 
+                ON DUPLICATE KEY UPDATE version = version + 1''', [(state,) for state in states])
+        self.connection.commit()
+    def upsert_prices(self, rows, batch_size=1000):
+        """Bulk, idempotent version of insert_price for an iterable of (state, date, price) rows."""
+        return self.upsert_rows('retail_residential_prices', 'price', rows, batch_size)
+    def upsert_sales(self, rows, batch_size=1000):
+        """Bulk, idempotent version of insert_sale for an iterable of (state, date, sales) rows."""
+        return self.upsert_rows('retail_residential_sales', 'sales', rows, batch_size)
+    def latest_dates(self, table):
+        """Return a dict mapping each state to the most recent date in a table."""
+        with self.connection.cursor() as cursor:
+            cursor.execute('''SELECT state, MAX(date) FROM {} GROUP BY state'''.format(table))
+            return dict(cursor.fetchall())
     def insert_price(self, state, date, price):
         """Insert a price for a given state and date into the appropriate MySQL table."""
         # if a variable is missing, it's an empty string; set that to None instead so that it becomes NULL in the db
@@ -92,6 +195,7 @@ class EIA_DB(object):
         with self.connection.cursor() as cursor:
             cursor.execute(sql, (state, date, price))
         self.connection.commit()
+        self.bump_versions([state])
     def insert_sale(self, state, date, sale):
         """Insert a 'sale' (really, consumption figure) for a given state and date into the 
         appropriate MySQL table.
@@ -109,6 +213,7 @@ class EIA_DB(object):
         with self.connection.cursor() as cursor:
             cursor.execute(sql, (state, date, sale))
         self.connection.commit()
+        self.bump_versions([state])
     def get_price(self, month, state):
         '''Return a floating point value in DOLLARS per kWh for the most recent 
         month argument and state.
@@ -173,18 +278,160 @@ class EIA_DB(object):
         """Close the database connection."""
         self.connection.close()
 
+class EIA_Snapshot(EIA_DB):
+    """An in-memory snapshot of the EIA price and sales tables, with the same read methods as EIA_DB.
+    Both tables are loaded with one bulk query each, and every state's 12-month price vector and 
+    monthly average consumption profile are precomputed as arrays. The snapshot reads the per-state 
+    versions in state_versions at most every check_interval seconds, and reloads only the states whose 
+    version has changed (e.g. because new EIA data was ingested, by this or any other process). Each 
+    refresh builds a new snapshot and swaps it in whole, so readers never see a partial refresh.
+    """
+    def __init__(self, db_url, db_name, check_interval=60):
+        """Instantiate an EIA_Snapshot object. Nothing is loaded until the first read."""
+        self.db_url = db_url
+        self.db_name = db_name
+        self.connection = None
+        self.check_interval = check_interval
+        self.data = None
+        self.versions = {}
+        self.checked = 0
+        self.lock = threading.Lock()
+    def state_versions(self, cursor):
+        """Return a dict mapping each state to its current version in state_versions."""
+        cursor.execute('''SELECT state, version FROM state_versions''')
+        return dict(cursor.fetchall())
+    def load(self, cursor, states=None):
+        """Return a new snapshot: for each table, a dict mapping states to (dates, values), most recent first, 
+        plus the precomputed per-state price vectors and consumption profiles (index m - 1 is month m).
+        If a list of states is passed, only those are read from MySQL, and the others are carried over 
+        from the current snapshot.
+        """
+        data = {}
+        loaded = {}
+        for table, column in (('retail_residential_prices', 'price'), ('retail_residential_sales', 'sales')):
+            if states:
+                sql = '''SELECT state, date, {} FROM {} WHERE state IN ({}) ORDER BY state, date DESC'''.format(
+                    column, table, ', '.join(['%s'] * len(states)))
+                cursor.execute(sql, tuple(states))
+            else:
+                cursor.execute('''SELECT state, date, {} FROM {} ORDER BY state, date DESC'''.format(column, table))
+            rows = {}
+            for state, date, value in cursor.fetchall():
+                rows.setdefault(state, ([], []))
+                rows[state][0].append(date)
+                rows[state][1].append(value)
+            loaded[table] = {state: (dates, np.array(values, dtype=float)) for state, (dates, values) in rows.items()}
+        for key in ('retail_residential_prices', 'retail_residential_sales', 'price_vectors', 'consump_profiles'):
+            data[key] = dict(self.data[key]) if states else {}
+        data['retail_residential_prices'].update(loaded['retail_residential_prices'])
+        data['retail_residential_sales'].update(loaded['retail_residential_sales'])
+        for state, (dates, values) in loaded['retail_residential_prices'].items():
+            vector = np.full(12, np.nan)
+            # Same rows as get_price: the most recent 12 months
+            for date, value in zip(dates[:12], values[:12]):
+                vector[date.month - 1] = value
+            data['price_vectors'][state] = vector
+        for state, (dates, values) in loaded['retail_residential_sales'].items():
+            # Same rows as get_avg_monthly_consump: the most recent 60 months
+            months = np.array([date.month for date in dates[:60]])
+            data['consump_profiles'][state] = np.array([values[:60][months == m].mean() for m in range(1, 13)])
+        return data
+    def current(self):
+        """Return the current snapshot, loading it first, or reloading the states that have changed, if necessary."""
+        now = time.time()
+        if self.data is None or now - self.checked > self.check_interval:
+            with self.lock:
+                if self.data is None or now - self.checked > self.check_interval:
+                    with get_mysql_pool(self.db_url, self.db_name).connection() as connection:
+                        with connection.cursor() as cursor:
+                            versions = self.state_versions(cursor)
+                            if self.data is None:
+                                print("Loading EIA snapshot.")
+                                self.data = self.load(cursor)
+                            else:
+                                changed = [state for state, version in versions.items() if self.versions.get(state) != version]
+                                if changed:
+                                    print("Reloading EIA snapshot for", ", ".join(sorted(changed)))
+                                    # Swap in the whole new snapshot at once
+                                    self.data = self.load(cursor, changed)
+                            self.versions = versions
+                    self.checked = now
+        return self.data
+    def state_version(self, state):
+        """Return the version of a state's rows in the current snapshot, which changes whenever they are reloaded."""
+        self.current()
+        return self.versions.get(state, 0)
+    def refresh(self):
+        """Force every state to be reloaded on the next read."""
+        with self.lock:
+            self.versions = {}
+            self.checked = 0
+    def refresh_states(self, states):
+        """Reload only the given states now, e.g. right after an incremental sync in this process. Other 
+        processes pick the same states up from their versions on their next check.
+        """
+        states = list(states)
+        with self.lock:
+            with get_mysql_pool(self.db_url, self.db_name).connection() as connection:
+                with connection.cursor() as cursor:
+                    versions = self.state_versions(cursor)
+                    if self.data is None:
+                        self.data = self.load(cursor)
+                        self.versions = versions
+                    elif states:
+                        self.data = self.load(cursor, states)
+                        self.versions = dict(self.versions, **{state: versions.get(state, 0) for state in states})
+            self.checked = time.time()
+    def price_vector(self, state):
+        """Return a 12-element array of the most recent cents per kWh prices, in month order."""
+        return self.current()['price_vectors'][state]
+    def consump_profile(self, state):
+        """Return a 12-element array of the average monthly consumption (millions of kWh), in month order."""
+        return self.current()['consump_profiles'][state]
+    def get_price(self, month, state):
+        '''Return a floating point value in DOLLARS per kWh for the most recent 
+        month argument and state.
+        '''
+        price = self.price_vector(state)[month - 1]
+        # Like EIA_DB.get_price, fail if the most recent 12 months don't include month
+        if np.isnan(price):
+            raise KeyError("No price for month {} in {}".format(month, state))
+        return price / 100
+    def get_prices(self, state, periods=12):
+        '''Return a pandas DataFrame with year-month period index and cents per kWh 
+        values.
+        '''
+        dates, values = self.current()['retail_residential_prices'][state]
+        return pd.DataFrame(values[:periods], index=pd.to_datetime(pd.Series(dates[:periods])), columns=['cpkWh'])
+    def get_consump(self, state, periods):
+        '''Return a pandas DataFrame with year-month period index and millions of kWh values'''
+        dates, values = self.current()['retail_residential_sales'][state]
+        return pd.DataFrame(values[:periods], index=pd.to_datetime(pd.Series(dates[:periods])), columns=['mkWh'])
+    def get_avg_monthly_consump(self, state, periods=60):
+        '''Return the monthly average of an arbitrary length series of year-month state consumption data'''
+        if periods != 60:
+            return EIA_DB.get_avg_monthly_consump(self, state, periods)
+        # Months without any sales are left out, as they are by EIA_DB.get_avg_monthly_consump
+        return pd.DataFrame(self.consump_profile(state), index=pd.Index(range(1, 13)), columns=['mkWh']).dropna()
+
 class EIA_API(object):
     """This class defines methods for interacting with the EIA API.
     This API is rate-limited to 100,000 requests per day.
     """
-    def __init__(self): 
-        """Instantiate an EIA_API object."""       
-        self.api_key = open("eia_api_key.txt", "r").readline().rstrip()
-        self.cat_url = "http://api.eia.gov/category/"
-        self.ser_url = "http://api.eia.gov/series/"
-        self.ser_cat_url = "http://api.eia.gov/series/categories/"
-        self.updates_url = "http://api.eia.gov/updates/"
-        self.search_url = "http://api.eia.gov/search/"
+    def __init__(self, base_url="http://api.eia.gov/", client=None, api_key=None): 
+        """Instantiate an EIA_API object. 
+        Pass a different base_url to use e.g. a local server of recorded responses (see harvest.py), 
+        and a harvest.HTTPClient to control rate limiting, retries and response caching. By default, requests
+        are limited by harvest.eia_limiter, which all EIA_API instances in the process share. The API key 
+        is read from eia_api_key.txt unless one is passed.
+        """       
+        self.api_key = api_key if api_key is not None else open("eia_api_key.txt", "r").readline().rstrip()
+        self.client = client if client is not None else HTTPClient(limiter=eia_limiter)
+        self.cat_url = base_url + "category/"
+        self.ser_url = base_url + "series/"
+        self.ser_cat_url = base_url + "series/categories/"
+        self.updates_url = base_url + "updates/"
+        self.search_url = base_url + "search/"
 
         self.retail_sales_resident_cat = 1002
         self.avg_retail_price_resident_cat = 1012
@@ -193,13 +440,18 @@ class EIA_API(object):
         self.avg_retail_price_resident_series_map = self.make_state_to_series_map(self.avg_retail_price_resident_cat)
         self.eia_db_url = "localhost"
         self.eia_db_name = "eia"
-        self.eia_db = EIA_DB(self.eia_db_url, self.eia_db_name)
+        self._eia_db = None
+    @property
+    def eia_db(self):
+        '''An EIA_DB for eia_db_url and eia_db_name, connected on first use.'''
+        if self._eia_db is None:
+            self._eia_db = EIA_DB(self.eia_db_url, self.eia_db_name)
+        return self._eia_db
     def make_state_to_series_map(self, cat):
         '''Return a dictionary mapping state codes to series names for a given category'''
         state_to_series_map = {}
         param_dict = {"api_key": self.api_key, "category_id": cat , "out":"json"}
-        r = requests.get(self.cat_url, params=param_dict)
-        data = r.json()
+        data = self.client.get_json(self.cat_url, param_dict)
         for series in data['category']['childseries']:
             # monthly frequency series only
             if series['f'] == 'M':
@@ -209,14 +461,18 @@ class EIA_API(object):
                 if len(abbr) == 2 and abbr != 'US':
                     state_to_series_map[abbr] = series['series_id']
         return state_to_series_map
-    def get_series(self, cat, series_map, state, periods):
-        '''Return JSON for a specified series, state (two letter code), and number of periods'''
+    def get_series(self, cat, series_map, state, periods, start=None):
+        '''Return JSON for a specified series, state (two letter code), and number of periods.
+        Pass start as 'YYYYMM' to get all periods from that month on instead.
+        '''
         param_dict = {"api_key": self.api_key, "series_id": series_map[state], "num": periods, "out": "json"}
-        r = requests.get(self.ser_url, params=param_dict)
-        return r.json()    
-    def get_consump(self, state, periods):
+        if start is not None:
+            del param_dict["num"]
+            param_dict["start"] = start
+        return self.client.get_json(self.ser_url, param_dict)
+    def get_consump(self, state, periods, start=None):
         '''Return a pandas DataFrame with year-month period index and millions of kWh values'''
-        json = self.get_series(self.retail_sales_resident_cat, self.retail_sales_resident_series_map, state, periods)
+        json = self.get_series(self.retail_sales_resident_cat, self.retail_sales_resident_series_map, state, periods, start)
         data = json['series'][0]['data']
         timestamps = [i for i in zip(*data)][0]
         values = [i for i in zip(*data)][1]
@@ -248,9 +504,9 @@ class EIA_API(object):
                                              index = avg_monthly_consump.index, 
                                              columns = ['kWh'])
         return consump
-    def get_prices(self, state, periods=60):
+    def get_prices(self, state, periods=60, start=None):
         '''Return a pandas DataFrame with year-month period index and cents per kWh values'''
-        json = self.get_series(self.avg_retail_price_resident_cat, self.avg_retail_price_resident_series_map, state, periods)
+        json = self.get_series(self.avg_retail_price_resident_cat, self.avg_retail_price_resident_series_map, state, periods, start)
         data = json['series'][0]['data']
         timestamps = [i for i in zip(*data)][0]
         values = [i for i in zip(*data)][1]
@@ -266,28 +522,67 @@ class EIA_API(object):
         prices.index = prices.index.month
         dpkwh = float(prices.loc[month] / 100)
         return dpkwh
-    def dump_prices(self):
-        '''Query API for all states, dump all prices to an SQL database.'''
+    def get_updates(self, cat, since=None, rows=10000):
+        '''Return a dict mapping the IDs of series in a category to when they were last updated, optionally 
+        only those updated after since (an ISO 8601 string such as '2015-06-01T00:00:00').
+        '''
+        updates = {}
+        firstrow = 0
+        while True:
+            param_dict = {"api_key": self.api_key, "category_id": cat, "deep": "true", 
+                          "rows": rows, "firstrow": firstrow, "out": "json"}
+            page = self.client.get_json(self.updates_url, param_dict).get('updates', [])
+            for update in page:
+                if since is None or update['updated'] > since:
+                    updates[update['series_id']] = update['updated']
+            if len(page) < rows:
+                return updates
+            firstrow += rows
+    def sync(self, eia_db, since=None, snapshot=None):
+        '''Incrementally refresh eia_db: ask the updates endpoint which series have changed (since the 
+        optional ISO 8601 timestamp since), and for each of those states fetch and upsert only the months 
+        from the latest one already in the table on. The latest month is fetched again, because EIA revises 
+        recent figures. States that have no rows yet get the full 240 months. If an EIA_Snapshot is passed, 
+        only the affected states are reloaded into it. Return a dict of the states updated per table.
+        '''
+        updated = {}
+        for table, cat, series_map, fetch, load in (
+                ('retail_residential_prices', self.avg_retail_price_resident_cat, 
+                 self.avg_retail_price_resident_series_map, self.get_prices, eia_db.upsert_prices),
+                ('retail_residential_sales', self.retail_sales_resident_cat, 
+                 self.retail_sales_resident_series_map, self.get_consump, eia_db.upsert_sales)):
+            changed = self.get_updates(cat, since)
+            latest = eia_db.latest_dates(table)
+            states = [state for state, series_id in series_map.items() if series_id in changed]
+            rows = []
+            for state in states:
+                if state in latest:
+                    frame = fetch(state, None, start=latest[state].strftime('%Y%m'))
+                else:
+                    frame = fetch(state, 240)
+                rows.extend(self.frame_rows(state, frame))
+            load(rows)
+            updated[table] = states
+            print("Synced", len(rows), "rows for", len(states), "states into", table)
+        if snapshot is not None:
+            snapshot.refresh_states(set(updated['retail_residential_prices']) | set(updated['retail_residential_sales']))
+        return updated
+    def frame_rows(self, state, frame):
+        '''Yield (state, 'YYYY-MM', value) rows for a DataFrame returned by get_prices or get_consump.'''
+        for date, value in zip(frame.index, frame.iloc[:, 0]):
+            yield state, date.strftime('%Y-%m'), float(value)
+    def dump_prices(self, periods=240):
+        '''Query API for all states, and upsert all prices into an SQL database. Safe to re-run.'''
         eia_db = EIA_DB(mysql_url, mysql_db)
-        
-        for state in self.avg_retail_price_resident_series_map.keys():
-            print(state)
-            state_prices = self.get_prices(state, periods=240)
-            for row in state_prices.iterrows():
-                # The explicit str() cast on the price was necessary, unclear why
-                eia_db.insert_price(state, str(row[0]), str(row[1][0]))
-            eia_db.connection.commit()
-    def dump_sales(self):
-        '''Query API for all states, dump all consumption to an SQL database.'''
+        rows = (row for state in self.avg_retail_price_resident_series_map.keys()
+                for row in self.frame_rows(state, self.get_prices(state, periods=periods)))
+        return eia_db.upsert_prices(rows)
+    def dump_sales(self, periods=240):
+        '''Query API for all states, and upsert all consumption into an SQL database. Safe to re-run.'''
         eia_db = EIA_DB(mysql_url, mysql_db)
-        
-        for state in self.retail_sales_resident_series_map.keys():
-            print(state)
-            state_sales = self.get_consump(state, periods=240)
-            for row in state_sales.iterrows():
-                # The explicit str() cast on the price was necessary, unclear why
-                eia_db.insert_sale(state, str(row[0]), str(row[1][0]))
-            eia_db.connection.commit()
+        rows = (row for state in self.retail_sales_resident_series_map.keys()
+                for row in self.frame_rows(state, self.get_consump(state, periods=periods)))
+        return eia_db.upsert_sales(rows)
 
 def main():
     pass
@@ -296,6 +591,9 @@ def main():
     #eia = EIA_API()
     #eia.dump_prices()
     #eia.dump_sales()
+    # See harvest.py for a concurrent, rate-limited version
+    # Example of an incremental update, e.g. from a daily cron job.
+    #eia.sync(eia_db)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:23:39 2026
+
+@author: gjm
+
+This file takes care of fetching data from the EIA API quickly, without exceeding its quota.
+
+HTTPClient sends GET requests for JSON through one pooled requests.Session, waits on a token
+bucket so that we stay under the documented limit of 100,000 requests per day, and retries
+failed requests with exponential backoff. harvest() fetches every state's series from a pool of
+worker threads and streams the rows straight into EIA_DB's bulk loader as each state arrives.
+
+For testing without the network, HTTPClient can record the responses it gets to a directory,
+and serve_recorded() serves that directory on a local port that EIA_API can be pointed at:
+
+    server = serve_recorded('eia_responses/')
+    api = EIA_API(base_url='http://127.0.0.1:{}/'.format(server.server_port))
+
+HTTPClient can also keep a ResponseCache, a size-capped directory of responses keyed by URL and
+parameters (without the API key). Cached responses are revalidated with If-None-Match and
+If-Modified-Since, so unchanged series cost a 304 rather than a full download, and in offline
+mode they are replayed byte for byte without touching the network:
+
+    client = HTTPClient(cache=ResponseCache('../data/http_cache', offline=True))
+    api = EIA_API(client=client)
+
+The recorded server sends ETags and answers If-None-Match with a 304. To check the whole path,
+harvest twice from a stub server of generated responses; this exits non-zero if any rows are
+missing or any response isn't revalidated:
+
+    python harvest.py --check
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from email.utils import parsedate_to_datetime
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+class TokenBucket(object):
+    '''
+    Allow on average rate requests per second, with bursts of up to capacity requests.
+    '''
+    def __init__(self, rate=100000 / 86400, capacity=20):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    def acquire(self):
+        '''Take a token, waiting for one if necessary.'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Shared by every EIA_API in the process that isn't given its own client, so that together they stay under the quota
+eia_limiter = TokenBucket()
+
+def retry_after(value, default):
+    '''
+    Return the number of seconds to wait given a Retry-After header, which is either a number of seconds or
+    an HTTP date, or default if there is no usable header.
+    '''
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+class CacheMissError(KeyError):
+    '''
+    Designed to be raised when an offline ResponseCache has no response for a request.
+    '''
+    pass
+
+class ResponseCache(object):
+    '''
+    Keep HTTP response bodies in cache_dir, along with their ETag and Last-Modified validators, evicting the least
+    recently used ones once they take up more than max_bytes. In offline mode, HTTPClient serves requests from the
+    cache only, and raises CacheMissError for anything that isn't in it.
+    '''
+    ignored_params = ('api_key',)
+    def __init__(self, cache_dir, max_bytes=500 * 2**20, offline=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'revalidated': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        # key -> metadata; the bodies stay on disk
+        self.entries = {}
+        for name in os.listdir(cache_dir):
+            if name.endswith('.json'):
+                with open(os.path.join(cache_dir, name), 'r') as f:
+                    self.entries[name[:-len('.json')]] = json.load(f)
+    def key(self, url, params):
+        '''Return the cache key of a request: a hash of the URL and sorted parameters, except the API key.'''
+        params = sorted((k, str(v)) for k, v in params.items() if k not in self.ignored_params)
+        return hashlib.sha256(json.dumps([url, params]).encode('utf-8')).hexdigest()
+    def path(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+    def get(self, url, params):
+        '''Return the metadata of a cached response, or None if there is none.'''
+        with self.lock:
+            entry = self.entries.get(self.key(url, params))
+        if entry is None or not os.path.exists(self.path(entry['key'], '.body')):
+            return None
+        return entry
+    def validators(self, entry):
+        '''Return the conditional request headers that revalidate a cached response.'''
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+    def body(self, entry, revalidated=False):
+        '''Return the body of a cached response, exactly as it was received, and mark it as recently used.'''
+        with open(self.path(entry['key'], '.body'), 'rb') as f:
+            body = f.read()
+        with self.lock:
+            self.counts['revalidated' if revalidated else 'hits'] += 1
+            entry['used'] = time.time()
+        self.write_meta(entry)
+        return body
+    def put(self, url, params, body, headers):
+        '''Store a response body (bytes) and its validators, then evict old responses if over max_bytes.'''
+        key = self.key(url, params)
+        entry = {'key': key, 'url': url, 'params': {k: v for k, v in params.items() if k not in self.ignored_params},
+                 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'),
+                 'size': len(body), 'stored': time.time(), 'used': time.time()}
+        # Write to a temporary file first, so that a reader never sees half a body
+        tmp = self.path(key, '.body.{}.tmp'.format(threading.get_ident()))
+        with open(tmp, 'wb') as f:
+            f.write(body)
+        os.replace(tmp, self.path(key, '.body'))
+        self.write_meta(entry)
+        with self.lock:
+            self.counts['misses'] += 1
+            self.entries[key] = entry
+        self.evict()
+    def write_meta(self, entry):
+        tmp = self.path(entry['key'], '.json.{}.tmp'.format(threading.get_ident()))
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, self.path(entry['key'], '.json'))
+    def evict(self):
+        '''Remove the least recently used responses until the cache holds at most max_bytes.'''
+        with self.lock:
+            total = sum(entry['size'] for entry in self.entries.values())
+            victims = []
+            for entry in sorted(self.entries.values(), key=lambda entry: entry['used']):
+                if total <= self.max_bytes:
+                    break
+                total -= entry['size']
+                victims.append(self.entries.pop(entry['key']))
+            self.counts['evictions'] += len(victims)
+        for entry in victims:
+            for suffix in ('.json', '.body'):
+                try:
+                    os.remove(self.path(entry['key'], suffix))
+                except FileNotFoundError:
+                    pass
+    def stats(self):
+        '''Return a dict of cache statistics.'''
+        with self.lock:
+            stats = dict(self.counts)
+            stats.update({'entries': len(self.entries), 'bytes': sum(entry['size'] for entry in self.entries.values()),
+                          'max_bytes': self.max_bytes, 'offline': self.offline})
+        return stats
+
+class HTTPClient(object):
+    '''
+    Fetch JSON over one pooled session, optionally rate limited by a TokenBucket, retrying up to retries times
+    on connection errors, timeouts, 429 and 5xx responses. Pass record_dir to save every response there, and
+    a ResponseCache to revalidate responses instead of downloading them again (or to replay them offline).
+    '''
+    def __init__(self, limiter=None, retries=5, backoff=0.5, timeout=30, pool_size=10, record_dir=None, cache=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.record_dir = record_dir
+        self.cache = cache
+    def get_json(self, url, params):
+        '''Return the decoded JSON response to a GET request.'''
+        data = json.loads(self.get_content(url, params).decode('utf-8'))
+        if self.record_dir is not None:
+            with open(os.path.join(self.record_dir, response_name(url, params)), 'w') as f:
+                json.dump(data, f)
+        return data
+    def get_content(self, url, params):
+        '''Return the body (bytes) of the response to a GET request, from the cache if it's still valid.'''
+        entry = self.cache.get(url, params) if self.cache is not None else None
+        if self.cache is not None and self.cache.offline:
+            if entry is None:
+                raise CacheMissError("No cached response for {} {}".format(url, self.cache.key(url, params)))
+            return self.cache.body(entry)
+        headers = self.cache.validators(entry) if entry is not None else {}
+        for attempt in range(self.retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                r = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+                if r.status_code == 304 and entry is not None:
+                    return self.cache.body(entry, revalidated=True)
+                if r.status_code != 429 and r.status_code < 500:
+                    r.raise_for_status()
+                    if self.cache is not None:
+                        self.cache.put(url, params, r.content, r.headers)
+                    return r.content
+                # Honor the server's Retry-After, if it sent one
+                delay = retry_after(r.headers.get('Retry-After'), self.backoff * 2**attempt)
+                error = requests.HTTPError("{} for {}".format(r.status_code, url))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                delay = self.backoff * 2**attempt
+                error = e
+            if attempt < self.retries:
+                print("Retrying {} in {:.1f} s: {}".format(url, delay, error))
+                time.sleep(delay * random.uniform(1, 1.5))
+        raise error
+
+def response_name(url, params):
+    '''Return the file name that a recorded response is saved under, e.g. series_ELEC.PRICE.CT-RES.M.json.'''
+    endpoint = urlparse(url).path.strip('/').split('/')[-1]
+    key = params.get('series_id', params.get('category_id', ''))
+    return '{}_{}.json'.format(endpoint, key)
+
+def harvest(api, eia_db, workers=8):
+    '''
+    Fetch prices and sales for all states with workers threads, and upsert them into eia_db as they arrive.
+    api is an EIA_API, preferably with a rate-limited HTTPClient. Return the number of rows loaded.
+    '''
+    count = 0
+    for kind, series_map, load in (('prices', api.avg_retail_price_resident_series_map, eia_db.upsert_prices),
+                                   ('sales', api.retail_sales_resident_series_map, eia_db.upsert_sales)):
+        fetch = api.get_prices if kind == 'prices' else api.get_consump
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch, state, 240): state for state in series_map.keys()}
+            rows = (row for future in as_completed(futures)
+                    for row in api.frame_rows(futures[future], future.result()))
+            count += load(rows)
+    return count
+
+class RecordedHandler(BaseHTTPRequestHandler):
+    '''
+    Serve recorded responses from the server's record_dir, looked up by response_name, with an ETag so that
+    conditional requests get a 304. The server counts the responses it sends in its counts dict.
+    '''
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = os.path.join(self.server.record_dir, response_name(url.path, params))
+        if not os.path.exists(path):
+            self.count(404)
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:16])
+        if self.headers.get('If-None-Match') == etag:
+            self.count(304)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.count(200)
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def count(self, status):
+        with self.server.lock:
+            self.server.counts[status] = self.server.counts.get(status, 0) + 1
+    def log_message(self, format, *args):
+        pass
+
+def serve_recorded(record_dir, port=0):
+    '''Serve the responses recorded in record_dir on a local port (any free one by default) in a background thread.'''
+    server = ThreadingHTTPServer(('127.0.0.1', port), RecordedHandler)
+    server.record_dir = record_dir
+    server.counts = {}
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class RowCollector(object):
+    '''Stands in for EIA_DB as the destination of harvest(), keeping the rows it's given in memory.'''
+    def __init__(self):
+        self.rows = {'prices': [], 'sales': []}
+    def upsert_prices(self, rows):
+        self.rows['prices'].extend(rows)
+        return len(self.rows['prices'])
+    def upsert_sales(self, rows):
+        self.rows['sales'].extend(rows)
+        return len(self.rows['sales'])
+
+def write_stub_responses(record_dir, states=('CT', 'MD', 'NY'), months=24):
+    '''
+    Write category and series responses in the EIA API's format for a few states to record_dir, and return the
+    rows that harvesting them should load, as a dict of sorted (state, 'YYYY-MM', value) lists per kind.
+    '''
+    expected = {}
+    for kind, code, cat in (('prices', 'PRICE', 1012), ('sales', 'SALES', 1002)):
+        series = {state: 'ELEC.{}.{}-RES.M'.format(code, state) for state in states}
+        childseries = [{'series_id': series_id, 'f': 'M'} for series_id in series.values()]
+        # Annual and national series are left out of the state map
+        childseries += [{'series_id': 'ELEC.{}.US-RES.M'.format(code), 'f': 'M'},
+                        {'series_id': 'ELEC.{}.CT-RES.A'.format(code), 'f': 'A'}]
+        with open(os.path.join(record_dir, response_name('/category/', {'category_id': cat})), 'w') as f:
+            json.dump({'category': {'category_id': cat, 'childseries': childseries}}, f)
+        expected[kind] = []
+        for i, (state, series_id) in enumerate(sorted(series.items())):
+            data = [['{}{:02d}'.format(2015 - m // 12, 12 - m % 12), round(10.0 + i + m / 100, 2)] for m in range(months)]
+            with open(os.path.join(record_dir, response_name('/series/', {'series_id': series_id})), 'w') as f:
+                json.dump({'series': [{'series_id': series_id, 'data': data}]}, f)
+            expected[kind] += [(state, '{}-{}'.format(date[:4], date[4:]), value) for date, value in data]
+        expected[kind].sort()
+    return expected
+
+def check_stub(workers=4):
+    '''
+    Harvest from serve_recorded twice, through an HTTPClient with a ResponseCache, and return a list of problems 
+    (empty if there are none): the first run must load every recorded row, and the second must revalidate every 
+    response with a 304 and load the same rows again.
+    '''
+    import tempfile
+    from eia import EIA_API
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        record_dir = os.path.join(tmp, 'responses')
+        os.makedirs(record_dir)
+        expected = write_stub_responses(record_dir)
+        server = serve_recorded(record_dir)
+        base_url = 'http://127.0.0.1:{}/'.format(server.server_port)
+        cache = ResponseCache(os.path.join(tmp, 'cache'))
+        try:
+            for run in (1, 2):
+                before = dict(server.counts)
+                api = EIA_API(base_url=base_url, client=HTTPClient(retries=0, cache=cache), api_key='stub')
+                collector = RowCollector()
+                count = harvest(api, collector, workers)
+                for kind in ('prices', 'sales'):
+                    if sorted(collector.rows[kind]) != expected[kind]:
+                        problems.append("run {}: harvested {} {} rows, expected {}".format(
+                            run, len(collector.rows[kind]), kind, len(expected[kind])))
+                if count != len(expected['prices']) + len(expected['sales']):
+                    problems.append("run {}: harvest() returned {} rows".format(run, count))
+                sent = {status: server.counts.get(status, 0) - before.get(status, 0) for status in (200, 304, 404)}
+                # Two categories, plus one series per state for each of them
+                requests_made = 2 + len(api.avg_retail_price_resident_series_map) + len(api.retail_sales_resident_series_map)
+                wanted = {200: requests_made, 304: 0, 404: 0} if run == 1 else {200: 0, 304: requests_made, 404: 0}
+                if sent != wanted:
+                    problems.append("run {}: the server sent {}, expected {}".format(run, sent, wanted))
+            stats = cache.stats()
+            if stats['revalidated'] != requests_made or stats['misses'] != requests_made:
+                problems.append("cache stats {} don't show one miss and one revalidation per request".format(stats))
+        finally:
+            server.shutdown()
+            server.server_close()
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent, rate-limited EIA harvesting.")
+    parser.add_argument('--check', action='store_true',
+                        help="harvest from a local stub server, and check the rows and the ETag/304 revalidation")
+    args = parser.parse_args()
+    if args.check:
+        problems = check_stub()
+        for problem in problems:
+            print("Check failed:", problem)
+        if problems:
+            sys.exit(1)
+        print("Harvest against the stub server: all rows loaded, and every response revalidated with a 304.")
+    # Example of a concurrent harvest into the MySQL database, rate limited by eia_limiter.
+    #from eia import EIA_API, EIA_DB
+    #api = EIA_API()
+    #harvest(api, EIA_DB("localhost", "eia"))
+    # The same, caching responses so that the next run only revalidates them
+    #api = EIA_API(client=HTTPClient(limiter=eia_limiter, cache=ResponseCache('../data/http_cache')))
+
+if __name__ == "__main__":
+    main()
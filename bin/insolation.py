@@ -13,61 +13,98 @@ import pymongo
 import pandas as pd
 import calendar
 
+# A 12-tuple of uppercase month abbreviations, which were keys in the original data
+month_abbrs = tuple(calendar.month_abbr[i].upper() for i in range(1,13))
+
 class PolyFindError(IndexError):
     '''
     Designed to be raised when poly_find method fails.
     '''
     pass
 
+def shapefile_docs(file):
+    '''Yield documents, one per polygon in the shapefile, each consisting of a location 
+    (a GeoJSON polygon), attributes (photovoltaic insolation data), and the 12 monthly 
+    insolation values in month order. Shapes and records are read one at a time, so 
+    the whole shapefile is never held in memory.
+    '''
+    sf = shapefile.Reader(file)
+    # Records only include 15 entries, but there are 16 fields
+    # Thus we exclude the first field, which is a DeletionFlag and unneeded
+    keys = sf.fields[1:]
+    for shape_record in sf.iterShapeRecords():
+        points = [list(coordinate) for coordinate in shape_record.shape.points]
+        loc = {"type": "Polygon", "coordinates": [points]}
+        attributes = {}
+        for key, value in zip(keys, shape_record.record):
+            # The first item of the key is the key label
+            attributes[key[0]] = value
+        monthly = [attributes[abbr] for abbr in month_abbrs]
+        yield {"loc": loc, "attributes": attributes, "monthly": monthly}
+
 class Insolation(object):
     '''Return an instance of the Insolation class, which provides an interface for 
     storing and accessing insolation (solar hours) data.
     '''
-    def __init__(self):
-        self.db = pymongo.MongoClient().canisolar
-        # A 12-tuple of uppercase month abbreviations, which were keys in the original data
-        self.month_abbrs = tuple(calendar.month_abbr[i].upper() for i in range(1,13))
+    def __init__(self, index=None, client=None):
+        # Pass a client (e.g. db.get_mongo_client()) to share its connections, rather than opening new ones
+        if client is None:
+            client = pymongo.MongoClient()
+        self.db = client.canisolar
+        # Optionally, a spatial.PolygonIndex or raster.InsolationRaster to search instead of querying MongoDB
+        self.index = index
+        self.month_abbrs = month_abbrs
     def __len__(self):
         return self.db.insolation.count()
-    def populate(self, file):
+    def populate(self, file, batch_size=1000):
         '''Populate MongoDB with entries consisting of a location (points 
         comprising a polygon) and attributes (photovoltaic insolation data).
+        The shapefile is streamed into a fresh staging collection in batches, indexed, 
+        and then renamed over the insolation collection, so that lookups keep working 
+        (against the old data) for the whole reload. Return the number of polygons loaded.
         '''
-        sf = shapefile.Reader(file)
-        # Records only include 15 entries, but there are 16 fields
-        # Thus we exclude the first field, which is a DeletionFlag and unneeded
-        keys = sf.fields[1:]
-        
-        for shape, record in zip(sf.shapes(), sf.records()):
-            points = [list(coordinate) for coordinate in shape.points]
-            loc = {"type": "Polygon", "coordinates": [points]}
-            attributes = {}
-            for key, value in zip(keys, record):
-                # The first item of the key is the key label
-                attributes[key[0]] = value
-            data = {"loc": loc, "attributes": attributes}
-            self.db.insolation.insert_one(data)
-        self.poly_index()
-    def poly_index(self):
-        '''THIS METHOD IS BROKEN. Instead, create an index manually in the command line client.
-        Create a 2dsphere index. 
+        staging = self.db.insolation_staging
+        staging.drop()
+        count = 0
+        batch = []
+        for data in shapefile_docs(file):
+            batch.append(data)
+            if len(batch) >= batch_size:
+                # Ordered inserts keep the natural order, which decides the first match in get_insolation
+                staging.insert_many(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            staging.insert_many(batch)
+            count += len(batch)
+        self.poly_index(staging)
+        staging.rename('insolation', dropTarget=True)
+        print("Loaded", count, "polygons into the insolation collection.")
+        return count
+    def poly_index(self, collection=None):
+        '''Create a 2dsphere index on the locations of a collection (by default, the insolation collection).
         '''
-        self.db.insolation.createIndex( {"loc": "2dsphere" } )
+        if collection is None:
+            collection = self.db.insolation
+        collection.create_index([("loc", pymongo.GEOSPHERE)])
     def poly_find(self, lon, lat):
         '''Return a list of documents whose locations (polygons) contain the point, 
         which was passed in as (lon, lat). Note the order of arguments.
         '''
-        cursor = self.db.insolation.find( {"loc": 
-            {"$geoIntersects": 
-                {"$geometry": 
-                    {"type": "Point", 
-                    "coordinates": 
-                        [lon, lat] 
+        if self.index is not None:
+            polys = self.index.find(lon, lat)
+        else:
+            cursor = self.db.insolation.find( {"loc": 
+                {"$geoIntersects": 
+                    {"$geometry": 
+                        {"type": "Point", 
+                        "coordinates": 
+                            [lon, lat] 
+                        } 
                     } 
                 } 
-            } 
-        })
-        polys = [doc for doc in cursor]
+            })
+            polys = [doc for doc in cursor]
         if len(polys) < 1:
             # If no polygons were found, we were probably passed a coordinate for which we don't have any data
             print("ERROR: in Insolation.poly_find(): no matching polygons found; raising ValueError.")
@@ -80,7 +117,12 @@ class Insolation(object):
         with insolation data in kWh / m2 / day as values
         '''
         # When there are multiple matching polygons, use the first one.
-        data = self.poly_find(lon, lat)[0]
+        return self.doc_insolation(self.poly_find(lon, lat)[0])
+    def doc_insolation(self, data):
+        '''Same as get_insolation, for a document already returned by poly_find.'''
+        # Documents loaded by populate() already hold the values in month order
+        if 'monthly' in data:
+            return pd.DataFrame(data['monthly'], index=pd.Series(range(1,13)), columns=["kWhpm2"])
         timestamps = []
         values = []
         for key in data['attributes'].keys():
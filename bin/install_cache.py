@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:27:28 2026
+
+@author: gjm
+
+This file defines the InstallCache class, a columnar on-disk copy of the OpenPV installs.
+
+build_install_cache streams the installs out of MySQL in chunks (see OpenPV.iter_installs)
+and writes one directory per state, holding one typed .npy file per column: uint32 ids,
+float32 sizes and costs, datetime64[D] install dates, and zipcodes dictionary-encoded as
+uint16 codes into a small per-state table. The columns are left uncompressed so that they can
+be memory mapped; the narrow types keep them at a fraction of the size of the MySQL table.
+Analysis jobs and model refits can then read a state, or all of them, without querying MySQL:
+
+    python install_cache.py ../data/installs
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from openpv import install_columns
+
+cache_version = 1
+dtypes = {'id': np.uint32, 'size': np.float32, 'cost': np.float32, 'date_installed': 'datetime64[D]'}
+
+def write_partition(path, state, frames):
+    '''Write the installs of one state (a list of DataFrames) to path/state, and return the number of rows.'''
+    installs = pd.concat(frames, ignore_index=True)
+    directory = os.path.join(path, state)
+    os.makedirs(directory)
+    for column, dtype in dtypes.items():
+        np.save(os.path.join(directory, column + '.npy'), np.asarray(installs[column].values, dtype=dtype))
+    zipcodes, codes = np.unique(installs['zipcode'].fillna('').values.astype('U5'), return_inverse=True)
+    np.save(os.path.join(directory, 'zipcodes.npy'), zipcodes)
+    np.save(os.path.join(directory, 'zipcode.npy'), codes.astype(np.uint16))
+    return len(installs)
+
+def build_install_cache(openpv, path, chunksize=50000):
+    '''
+    Write all installs to a cache at path (a directory), reading them chunksize rows at a time. The cache is
+    built next to path and then swapped in, so readers never see half of it. Returns an InstallCache.
+    '''
+    tmp = path.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    rows = {}
+    state, frames = None, []
+    # Installs come ordered by state, so each state's chunks are contiguous
+    for chunk in openpv.iter_installs(chunksize=chunksize):
+        for chunk_state, frame in chunk.groupby('state', sort=False):
+            if chunk_state != state and frames:
+                rows[state] = write_partition(tmp, state, frames)
+                frames = []
+            state = chunk_state
+            frames.append(frame)
+    if frames:
+        rows[state] = write_partition(tmp, state, frames)
+    with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+        json.dump({'version': cache_version, 'built': time.time(), 'rows': rows,
+                   'dtypes': {column: np.dtype(dtype).str for column, dtype in dtypes.items()}}, f)
+    old = path.rstrip('/') + '.old'
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    return InstallCache(path)
+
+class InstallCache(object):
+    '''
+    Read a cache made by build_install_cache. Columns are memory mapped, and only read from disk when used.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != cache_version:
+            raise ValueError("Install cache version {} is not {}; rebuild it.".format(self.manifest['version'], cache_version))
+    def __len__(self):
+        return sum(self.manifest['rows'].values())
+    def states(self):
+        '''Return the states in the cache.'''
+        return sorted(self.manifest['rows'])
+    def columns(self, state):
+        '''
+        Return a dict of memory-mapped column arrays for a state. The zipcode column holds codes into the
+        'zipcodes' array, where '' means missing.
+        '''
+        directory = os.path.join(self.path, state)
+        columns = {column: np.load(os.path.join(directory, column + '.npy'), mmap_mode='r')
+                   for column in list(dtypes) + ['zipcode']}
+        columns['zipcodes'] = np.load(os.path.join(directory, 'zipcodes.npy'))
+        return columns
+    def frame(self, state=None):
+        '''Return installs as a DataFrame shaped like OpenPV.get_installs, optionally for a given state.'''
+        frames = []
+        for s in ([state] if state else self.states()):
+            columns = self.columns(s)
+            zipcodes = columns['zipcodes'][columns['zipcode']].astype(object)
+            zipcodes[zipcodes == ''] = None
+            frames.append(pd.DataFrame({'id': columns['id'], 'zipcode': zipcodes, 'state': s,
+                                        'size': columns['size'], 'cost': columns['cost'],
+                                        'date_installed': columns['date_installed']}, columns=install_columns))
+        if not frames:
+            return pd.DataFrame(columns=install_columns)
+        return pd.concat(frames, ignore_index=True)
+
+def main():
+    from openpv import OpenPV, db_url, db_name
+    parser = argparse.ArgumentParser(description="Build a columnar cache of the OpenPV installs.")
+    parser.add_argument('path', help="directory to write the cache to, e.g. ../data/installs")
+    parser.add_argument('--chunksize', type=int, default=50000, help="rows to read from MySQL at a time")
+    args = parser.parse_args()
+    openpv = OpenPV(db_url, db_name)
+    start = time.perf_counter()
+    cache = build_install_cache(openpv, args.path, args.chunksize)
+    openpv.close()
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(args.path) for name in names)
+    print("Cached {} installs in {} states in {:.2f} s ({:.1f} MB): {}".format(len(cache), len(cache.states()),
+          time.perf_counter() - start, size / 2**20, args.path))
+
+if __name__ == "__main__":
+    main()
@@ -6,29 +6,49 @@ Created on Fri Jun  5 09:23:38 2015
 
 This file contains the OpenPV class definiton.
 The OpenPV are available from https://openpv.nrel.gov/
+
+OpenPV.refresh_price_index maintains the price_index table of install cost per watt 
+quantiles by state, zipcode and year, which the web app reads to show local prices.
+
+It also contains the bulk loader for the per-state CSV exports. Each file is parsed 
+and validated in its own worker process and inserted in batches with executemany; 
+malformed rows are written to a quarantine file along with the reason, and the 
+load_progress table records which files are complete, so that an interrupted 
+load can be re-run and only redoes the unfinished files:
+
+    python openpv.py /Users/gjm/insight/canisolar/data/openpv/ --workers 4
 """
 
-import requests
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import csv
+import datetime
+import os
+import time
 import us
 import pymysql.cursors
-#import csv
-#from pymysql import DataError
 import pandas as pd
+from harvest import HTTPClient
 
-#db_url = "localhost"
-#db_name = "openpv"
+db_url = "localhost"
+db_name = "openpv"
+install_columns = ['id', 'zipcode', 'state', 'size', 'cost', 'date_installed']
+# Cost per watt quantiles kept in the price_index table, as columns p10, p25, etc.
+price_quantiles = (0.10, 0.25, 0.50, 0.75, 0.90)
 #openpv_data_path = "/Users/gjm/insight/canisolar/data/openpv/"
 
 
 class OpenPV(object):
-	"""This class defines methods for accessing the (undocumented) OpenPV API, 
-	and for insertion and retrieval of this data to/from a MySQL database.
-	"""
-    def __init__(self, db_url, db_name):
-		"""Instantiate an OpenPV object.
-		"""    
+    """This class defines methods for accessing the (undocumented) OpenPV API, 
+    and for insertion and retrieval of this data to/from a MySQL database.
+    """
+    def __init__(self, db_url, db_name, client=None):
+        """Instantiate an OpenPV object.
+        Pass a harvest.HTTPClient, e.g. one with a ResponseCache, to control how the API is fetched.
+        """    
         # This API key is available on the OpenPV site
         self.api_key = open("openpv_api_key.txt", "r").readline().rstrip()
+        self.client = client if client is not None else HTTPClient()
         self.url = "http://developer.nrel.gov/api/solar/open_pv"
         self.csv_url = "http://developer.nrel.gov/api/solar/open_pv/installs/index"
         # Create a list of two-letter state abbreviations (including DC)
@@ -54,7 +74,7 @@ class OpenPV(object):
         # Create tables (if they don't already exist)
         self.create_tables()
     def create_db(self):
-    """Create the database, if necessary."""
+        """Create the database, if necessary."""
         # Can't use parameters with database/table names
         # Technically insecure against the script operator
         sql = ' '.join(['''CREATE DATABASE IF NOT EXISTS ''', self.db_name,  
@@ -63,30 +83,71 @@ class OpenPV(object):
             cursor.execute(sql)
         self.connection.commit()        
     def create_tables(self):
-    """Create the database tables, if necessary."""
+        """Create the database tables, if necessary."""
         item_data = '''CREATE TABLE IF NOT EXISTS installs (
             id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, 
             zipcode CHAR(5), 
             state CHAR(2),
             size FLOAT,
             cost FLOAT,
-            date_installed DATE
+            date_installed DATE,
+            source VARCHAR(255),
+            KEY source (source)
+            )
+            ENGINE=MyISAM'''
+        # One row per CSV file loaded by load_csv_dir
+        progress = '''CREATE TABLE IF NOT EXISTS load_progress (
+            filename VARCHAR(255) NOT NULL PRIMARY KEY, 
+            size BIGINT UNSIGNED, 
+            mtime DOUBLE,
+            rows_loaded INT UNSIGNED,
+            rows_quarantined INT UNSIGNED,
+            complete BOOL NOT NULL DEFAULT FALSE
+            )
+            ENGINE=MyISAM'''
+        # Cost per watt quantiles and counts by state, zipcode and year, maintained by refresh_price_index. 
+        # Rows with an empty zipcode cover the whole state.
+        price_index = '''CREATE TABLE IF NOT EXISTS price_index (
+            state CHAR(2) NOT NULL, 
+            zipcode CHAR(5) NOT NULL, 
+            year SMALLINT UNSIGNED NOT NULL,
+            installs INT UNSIGNED NOT NULL,
+            {},
+            PRIMARY KEY (state, zipcode, year)
+            )
+            ENGINE=MyISAM'''.format(',\n            '.join('p{:.0f} FLOAT'.format(q * 100) for q in price_quantiles))
+        # The highest install id that price_index has seen
+        price_index_progress = '''CREATE TABLE IF NOT EXISTS price_index_progress (
+            id TINYINT UNSIGNED NOT NULL PRIMARY KEY,
+            max_install_id INT UNSIGNED NOT NULL
             )
             ENGINE=MyISAM'''
         with self.connection.cursor() as cursor:
-            cursor.execute(item_data)
+            for sql in (item_data, progress, price_index, price_index_progress):
+                cursor.execute(sql)
         self.connection.commit()        
+    def migrate(self):
+        """Add the source column (the CSV file an install was loaded from) to installs tables created before 
+        it existed. Safe to run more than once. Installs loaded before then are left with a NULL source, and 
+        load_csv replaces them with the installs of its file for the same states.
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute('''SELECT COLUMN_NAME FROM information_schema.COLUMNS 
+                WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s''', (self.db_name, 'installs'))
+            columns = set(row[0] for row in cursor.fetchall())
+            if 'source' not in columns:
+                cursor.execute('''ALTER TABLE installs ADD COLUMN source VARCHAR(255), ADD KEY source (source)''')
+        self.connection.commit()
     def get_api_state_data(self, state):
-        '''Return a link to a CSV file for a given state.'''
+        '''Return the CSV export for a given state, as text.'''
         param_dict = {"export": "true", "api_key": self.api_key, "state": state, "pagenum": 1, "nppage": 25}
-        r = requests.get(self.csv_url, params=param_dict)
-        return r
+        return self.client.get_content(self.csv_url, param_dict).decode('utf-8')
     def get_api_state_csv(self, state):
         '''Save a CSV file export for a given state. Will overwrite without warning!'''
-        r = self.get_csv_data(state)
+        text = self.get_api_state_data(state)
         filename = "openpv_" + state + ".csv"
         f = open(filename, 'w')
-        f.write(r.text)
+        f.write(text)
         f.close()
     def get_api_all_csv(self):
         '''Save CSV files for all states. Will overwrite without warning!'''
@@ -107,46 +168,231 @@ class OpenPV(object):
         with self.connection.cursor() as cursor:
             cursor.execute(sql, (zipcode, state, size, cost, date_installed))
         self.connection.commit()
-    def get_installs(self, state=None):
+    def installs_query(self, state=None, since_id=None, before=None):
+        '''Return the SQL and parameters that select installs, optionally for a given state, and optionally 
+        only those with an id greater than since_id. Installs dated on or after before ('YYYY-MM-DD') are 
+        excluded; by default, only those dated in the future, which can't be right.'''
+        sql = '''SELECT id, zipcode, state, size, cost, date_installed FROM installs WHERE {}size > 0 AND cost > 0 AND date_installed >= '2000-01-01' ORDER BY state, date_installed ASC'''
+        conditions, params = '', ()
+        if state:
+            conditions, params = conditions + 'state = %s AND ', params + (state,)
+        if since_id is not None:
+            conditions, params = conditions + 'id > %s AND ', params + (since_id,)
+        if before is not None:
+            conditions, params = conditions + 'date_installed < %s AND ', params + (before,)
+        else:
+            conditions = conditions + 'date_installed <= CURDATE() AND '
+        return sql.format(conditions), params
+    def get_installs(self, state=None, before='2015-06-01'):
         '''Return a pandas DataFrame of installs, optionally for a given state.
         Note that some sanity checks have been included - we exclude installs with NULL 
         (or negative) sizes and costs, and we limit date_installed to dates after 
-        January 1, 2000, and before June 1, 2015 (when we downloaded the data).
+        January 1, 2000, and by default before June 1, 2015 (when we downloaded the data 
+        that openpv_analysis.R was fit on). For all states, iter_installs uses far less memory.
         '''
-        if state:
-            sql = '''SELECT * FROM installs WHERE state = %s AND size > 0 AND cost > 0 AND date_installed >= '2000-01-01'  AND date_installed < '2015-06-01' ORDER BY state, date_installed ASC'''
-            with self.connection.cursor() as cursor:
-                cursor.execute(sql, (state))
-        else:
-            sql = '''SELECT * FROM installs WHERE size > 0 AND cost > 0 AND date_installed >= '2000-01-01'  AND date_installed < '2015-06-01' ORDER BY state, date_installed ASC'''
-            with self.connection.cursor() as cursor:
-                cursor.execute(sql)            
-        results = cursor.fetchall()
-        installs = pd.DataFrame(list(results), columns=['id', 'zipcode', 'state', 'size', 'cost', 'date_installed'])
+        sql, params = self.installs_query(state, before=before)
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            results = cursor.fetchall()
+        installs = pd.DataFrame(list(results), columns=install_columns)
         return installs
+    def count_installs(self, max_id):
+        '''Return the number of rows in installs with an id of at most max_id, whether they pass the sanity checks or not.'''
+        with self.connection.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM installs WHERE id <= %s''', (max_id,))
+            return cursor.fetchone()[0]
+    def iter_installs(self, state=None, chunksize=50000, since_id=None, before=None):
+        '''Yield the same installs as get_installs, as DataFrames of at most chunksize rows. Unlike get_installs, 
+        there is no cutoff date by default, so that incremental consumers keep up with newly loaded installs.
+        Rows are streamed from the server with an unbuffered cursor rather than fetched all at once, 
+        so the connection can't run other queries until the generator is exhausted or closed.
+        '''
+        sql, params = self.installs_query(state, since_id, before)
+        with self.connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield pd.DataFrame(list(rows), columns=install_columns)
+    def refresh_price_index(self, full=False):
+        '''Bring the price_index table up to date with installs, and return the states that were recomputed.
+        Only states with installs added since the last refresh are recomputed, unless full is True. Quantiles 
+        can't be merged, so each of those states is recomputed from all of its installs (with the same sanity 
+        checks as get_installs), which also accounts for installs deleted and reloaded by load_csv.
+        '''
+        with self.connection.cursor() as cursor:
+            cursor.execute('''SELECT MAX(id) FROM installs''')
+            latest = cursor.fetchone()[0] or 0
+            cursor.execute('''SELECT max_install_id FROM price_index_progress WHERE id = 1''')
+            row = cursor.fetchone()
+            seen = row[0] if row is not None and not full else 0
+            cursor.execute('''SELECT DISTINCT state FROM installs WHERE id > %s AND state IS NOT NULL''', (seen,))
+            states = sorted(row[0] for row in cursor.fetchall())
+        columns = ['p{:.0f}'.format(q * 100) for q in price_quantiles]
+        sql = '''INSERT INTO price_index (state, zipcode, year, installs, {}) VALUES ({})'''.format(
+            ', '.join(columns), ', '.join(['%s'] * (4 + len(columns))))
+        for state in states:
+            installs = pd.concat(list(self.iter_installs(state)) or [pd.DataFrame(columns=install_columns)])
+            installs['year'] = pd.to_datetime(installs['date_installed']).dt.year
+            installs['cost_per_watt'] = installs['cost'] / (installs['size'] * 1000)
+            installs['zipcode'] = installs['zipcode'].fillna('')
+            # Installs without a zipcode only count towards the state as a whole
+            groups = pd.concat([installs[installs['zipcode'] != ''], installs.assign(zipcode='')])
+            grouped = groups.groupby(['zipcode', 'year'])['cost_per_watt']
+            counts = grouped.size()
+            stats = grouped.quantile(list(price_quantiles)).unstack()
+            rows = [(state, zipcode, int(year), int(count)) + tuple(float(x) for x in stats.loc[(zipcode, year)])
+                    for (zipcode, year), count in counts.items()]
+            with self.connection.cursor() as cursor:
+                cursor.execute('''DELETE FROM price_index WHERE state = %s''', (state,))
+                cursor.executemany(sql, rows)
+            self.connection.commit()
+            print("Indexed", len(rows), "price groups for", state)
+        with self.connection.cursor() as cursor:
+            cursor.execute('''REPLACE INTO price_index_progress (id, max_install_id) VALUES (1, %s)''', (latest,))
+        self.connection.commit()
+        return states
     def close(self):
-    	"""Close the database connection."""
+        """Close the database connection."""
         self.connection.close()
 
+def parse_row(row):
+    '''
+    Return the (zipcode, state, size, cost, date_installed) values of a CSV row, ready to insert, with the date 
+    as 'YYYY-MM-DD'. Missing values become None, as in insert_item_data. Raise ValueError if the row is malformed.
+    '''
+    if len(row) < 5:
+        raise ValueError("expected at least 5 columns, got {}".format(len(row)))
+    # Don't include the last two columns which are blank
+    zipcode, state, size, cost, date_installed = [value.strip() or None for value in row[:5]]
+    if zipcode is not None and len(zipcode) > 5:
+        raise ValueError("zipcode {!r} is longer than 5 characters".format(zipcode))
+    if state is not None and len(state) != 2:
+        raise ValueError("state {!r} is not a two letter code".format(state))
+    try:
+        size = float(size) if size is not None else None
+    except ValueError:
+        raise ValueError("size {!r} is not a number".format(size))
+    try:
+        cost = float(cost) if cost is not None else None
+    except ValueError:
+        raise ValueError("cost {!r} is not a number".format(cost))
+    if date_installed is not None:
+        try:
+            date_installed = datetime.datetime.strptime(date_installed, '%m/%d/%Y').strftime('%Y-%m-%d')
+        except ValueError:
+            raise ValueError("date_installed {!r} is not a m/d/Y date".format(date_installed))
+    return zipcode, state, size, cost, date_installed
+
+def load_csv(db_url, db_name, path, quarantine_dir, batch_size=5000):
+    '''
+    Load one OpenPV CSV file into the installs table, batch_size rows per executemany, and write malformed rows 
+    to a CSV of the same name in quarantine_dir, with the reason appended. Rows left over from an earlier, 
+    interrupted load of the same file are deleted first, and once the file is loaded, so are the installs of 
+    its states that were loaded without a source (i.e. before migrate() added the column). Runs in a worker process, so it opens its own 
+    connection. Return a dict with the file name, the rows loaded and quarantined, and the seconds taken.
+    '''
+    filename = os.path.basename(path)
+    connection = pymysql.connect(host=db_url,
+        user='root',
+        passwd='',
+        db=db_name,
+        charset='utf8mb4',
+        autocommit=True,
+        cursorclass=pymysql.cursors.Cursor)
+    sql = '''INSERT INTO installs (zipcode, state, size, cost, date_installed, source) 
+        VALUES (%s, %s, %s, %s, %s, %s)'''
+    start = time.time()
+    loaded = quarantined = 0
+    states = set()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('''DELETE FROM installs WHERE source = %s''', (filename,))
+            cursor.execute('''REPLACE INTO load_progress (filename, size, mtime, rows_loaded, rows_quarantined, complete) 
+                VALUES (%s, %s, %s, 0, 0, FALSE)''', (filename, os.path.getsize(path), os.path.getmtime(path)))
+        with open(path, newline='') as csvfile, \
+             open(os.path.join(quarantine_dir, filename), 'w', newline='') as quarantine:
+            reader = csv.reader(csvfile)
+            rejects = csv.writer(quarantine)
+            # skip the first line, which is a header
+            rejects.writerow(next(reader, []) + ['line', 'reason'])
+            batch = []
+            for line, row in enumerate(reader, start=2):
+                try:
+                    values = parse_row(row)
+                    batch.append(values + (filename,))
+                    states.add(values[1])
+                except ValueError as e:
+                    rejects.writerow(row + [line, str(e)])
+                    quarantined += 1
+                    continue
+                if len(batch) >= batch_size:
+                    with connection.cursor() as cursor:
+                        cursor.executemany(sql, batch)
+                    loaded += len(batch)
+                    batch = []
+            if batch:
+                with connection.cursor() as cursor:
+                    cursor.executemany(sql, batch)
+                loaded += len(batch)
+        states.discard(None)
+        with connection.cursor() as cursor:
+            if states:
+                cursor.execute('''DELETE FROM installs WHERE source IS NULL AND state IN ({})'''.format(
+                    ', '.join(['%s'] * len(states))), tuple(sorted(states)))
+            cursor.execute('''UPDATE load_progress SET rows_loaded = %s, rows_quarantined = %s, complete = TRUE 
+                WHERE filename = %s''', (loaded, quarantined, filename))
+    finally:
+        connection.close()
+    return {'filename': filename, 'loaded': loaded, 'quarantined': quarantined, 'seconds': time.time() - start}
+
+def load_csv_dir(openpv, data_path, quarantine_dir=None, workers=4, batch_size=5000):
+    '''
+    Load every CSV file in data_path that hasn't been loaded completely yet (or has changed since), in workers 
+    processes. openpv is an OpenPV object for the target database. Return the total number of rows loaded.
+    '''
+    quarantine_dir = quarantine_dir if quarantine_dir is not None else os.path.join(data_path, 'quarantine')
+    os.makedirs(quarantine_dir, exist_ok=True)
+    with openpv.connection.cursor() as cursor:
+        cursor.execute('''SELECT filename, size, mtime FROM load_progress WHERE complete''')
+        done = {filename: (size, mtime) for filename, size, mtime in cursor.fetchall()}
+    paths = []
+    for filename in sorted(os.listdir(data_path)):
+        path = os.path.join(data_path, filename)
+        if not filename.endswith(".csv"):
+            continue
+        if done.get(filename) == (os.path.getsize(path), os.path.getmtime(path)):
+            print("Skipping", filename, "(already loaded)")
+            continue
+        paths.append(path)
+    start = time.time()
+    total = 0
+    # MyISAM locks the whole table for each insert, so the workers mostly overlap parsing with loading
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(load_csv, openpv.db_url, openpv.db_name, path, quarantine_dir, batch_size)
+                   for path in paths]
+        for future in as_completed(futures):
+            result = future.result()
+            total += result['loaded']
+            print("Loaded {loaded} rows from {filename} in {seconds:.2f} s, quarantined {quarantined}".format(**result))
+    elapsed = time.time() - start
+    print("Loaded {} rows from {} files in {:.2f} s ({:.0f} rows/sec)".format(total, len(paths), elapsed, 
+          total / elapsed if elapsed > 0 else float('inf')))
+    return total
+
 def main():
-    pass
-	# Code for populating MySQL database initially
-#    openpv = OpenPV(mysql_url, mysql_db)
-#    
-#    for filename in os.listdir(openpv_data_path):
-#        if filename.endswith(".csv"):
-#            with open(os.path.join(openpv_data_path, filename)) as csvfile:
-#                reader = csv.reader(csvfile)
-#                # skip the first line, which is a header
-#                reader.__next__()
-#                for row in reader:
-#                    try:
-#                        # Don't include the last two columns which are blank
-#                        (zipcode, state, size, cost, date_installed) = row[:-2]
-#                        openpv.insert_item_data(zipcode, state, size, cost, date_installed)
-#                    except DataError:
-#                        print(row)
-#                        continue
+    parser = argparse.ArgumentParser(description="Bulk load the OpenPV CSV exports into MySQL.")
+    parser.add_argument('data_path', help="directory of OpenPV CSV files, one per state")
+    parser.add_argument('--quarantine-dir', help="where to write malformed rows (default: data_path/quarantine)")
+    parser.add_argument('--workers', type=int, default=4, help="number of worker processes")
+    parser.add_argument('--batch-size', type=int, default=5000, help="rows per executemany")
+    args = parser.parse_args()
+    openpv = OpenPV(db_url, db_name)
+    openpv.migrate()
+    load_csv_dir(openpv, args.data_path, args.quarantine_dir, args.workers, args.batch_size)
+    openpv.refresh_price_index()
+    openpv.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:17:23 2026
+
+@author: gjm
+
+This file defines the PortableR class, an R-free replacement for the R class.
+
+The web tier only needs two kinds of prediction from R: price forecasts (mypredict on
+ts_model_list) and install costs (mod_fe_state_year). export_models turns both into a single
+versioned NumPy archive: the price forecasts for every state, and the cost model's
+coefficients, covariance matrix, residual standard error and t quantile. PortableR serves
+predict_prices and predict_cost from that archive without rpy2 or an R installation.
+Run this file (where R is available) to export the models and check parity with R, for every
+state's prices and all three cost bounds; it exits non-zero if any of them drift beyond tolerance.
+--check checks an existing archive, e.g. after the R models are refit:
+
+    python portable.py ../models/ ../models/canisolar_models.npz
+    python portable.py ../models/ ../models/canisolar_models.npz --check
+"""
+
+import argparse
+import datetime
+import json
+import sys
+import numpy as np
+
+# Bump this whenever the layout of the archive changes
+artifact_version = 1
+bounds = ('fit', 'lwr', 'upr')
+# The largest differences from R that check_parity accepts: absolute for prices (cents per kWh), relative for costs
+price_tolerance = 1e-6
+cost_tolerance = 1e-6
+
+def export_models(myr, path, horizon=360, year="2014"):
+    '''
+    Export price forecasts for horizon months and the install cost model (for installs in year) from an
+    R instance to path, as a compressed NumPy archive with a JSON metadata entry.
+    '''
+    r = myr.r
+    model = 'mod_fe_state_year'
+    price_states = sorted(r('''names(ts_model_list)'''))
+    forecasts = np.array([np.fromiter(myr.predict_prices(state, horizon), dtype=float) for state in price_states])
+    # Aliased coefficients are NA, and predict() drops them, so we do too
+    coef_names = list(r('''names(coef({m}))[!is.na(coef({m}))]'''.format(m=model)))
+    coef = np.fromiter(r('''coef({m})[!is.na(coef({m}))]'''.format(m=model)), dtype=float)
+    vcov = np.fromiter(r('''vcov({m}, complete=FALSE)'''.format(m=model)), dtype=float).reshape(len(coef), len(coef))
+    meta = {'version': artifact_version,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'horizon': horizon,
+            'price_states': price_states,
+            'cost_states': list(r('''{m}$xlevels$state'''.format(m=model))),
+            'year': year,
+            'coef_names': coef_names,
+            'sigma': float(r('''summary({m})$sigma'''.format(m=model))[0]),
+            'df': int(r('''{m}$df.residual'''.format(m=model))[0]),
+            # The 90% prediction interval uses the 95th percentile of the t distribution
+            't_crit': float(r('''qt(0.95, {m}$df.residual)'''.format(m=model))[0])}
+    # NumPy adds the extension if it's missing, so make sure we load the file it actually writes
+    if not path.endswith('.npz'):
+        path = path + '.npz'
+    np.savez_compressed(path, meta=np.array(json.dumps(meta)), forecasts=forecasts, coef=coef, vcov=vcov)
+    return PortableR(path)
+
+class PortableR(object):
+    '''
+    Load an archive made by export_models, and provide the same prediction interface as R.
+    '''
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.load_models()
+    def load_models(self):
+        '''
+        (Re)load the archive at model_path.
+        '''
+        with np.load(self.model_path) as artifact:
+            meta = json.loads(str(artifact['meta']))
+            if meta['version'] != artifact_version:
+                raise ValueError("Model archive version {} is not supported (expected {}); re-export the models.".format(
+                    meta['version'], artifact_version))
+            forecasts = artifact['forecasts']
+            coef = artifact['coef']
+            vcov = artifact['vcov']
+        self.meta = meta
+        self.forecasts = {state: forecasts[i] for i, state in enumerate(meta['price_states'])}
+        for prices in self.forecasts.values():
+            prices.flags.writeable = False
+        # For a given state, the design row is a constant part (intercept, state and year dummies) plus
+        # log(size) times a unit vector, so log cost and its variance are polynomials in log(size).
+        names = meta['coef_names']
+        size_col = np.zeros(len(names))
+        size_col[names.index('log(size)')] = 1.0
+        self.cost_terms = {}
+        for state in meta['cost_states']:
+            base = np.zeros(len(names))
+            for name in ('(Intercept)', 'state' + state, 'year_installed' + meta['year']):
+                # The first level of each factor is the baseline, and has no coefficient
+                if name in names:
+                    base[names.index(name)] = 1.0
+            self.cost_terms[state] = (base.dot(coef), size_col.dot(coef),
+                                      base.dot(vcov).dot(base), base.dot(vcov).dot(size_col),
+                                      size_col.dot(vcov).dot(size_col))
+    def cost_states(self):
+        '''
+        Return a list of the states that the cost model was fit on.
+        '''
+        return list(self.meta['cost_states'])
+    def predict_costs(self, state, sizes):
+        '''
+        Return a cost dict of numpy arrays with the point estimates and 90% prediction interval bounds,
+        one element per size in sizes. Same as the lm prediction intervals computed by R.predict_costs.
+        '''
+        intercept, slope, var_base, cov, var_size = self.cost_terms[state]
+        log_size = np.log(np.asarray(sizes, dtype=float))
+        log_fit = intercept + slope * log_size
+        var_fit = var_base + 2 * cov * log_size + var_size * log_size**2
+        margin = self.meta['t_crit'] * np.sqrt(var_fit + self.meta['sigma']**2)
+        return {'fit': np.exp(log_fit), 'lwr': np.exp(log_fit - margin), 'upr': np.exp(log_fit + margin)}
+    def predict_cost(self, state, size):
+        '''
+        Return cost in dollars as a dict with the point estimate and 90% lower and upper prediction interval bounds.
+        '''
+        cost = self.predict_costs(state, [size])
+        return {k: float(cost[k][0]) for k in bounds}
+    def predict_prices(self, state, periods):
+        '''
+        Return forecasted prices for a given state and number of periods (after March 2015)
+        '''
+        if periods > self.meta['horizon']:
+            raise ValueError("Only {} periods of prices were exported, but {} were requested.".format(
+                self.meta['horizon'], periods))
+        return self.forecasts[state][:periods]
+
+def check_parity(portable, myr, sizes=(1.0, 2.5, 5.0, 7.5, 10.0, 20.0)):
+    '''
+    Compare a PortableR against the live R models, and return the maximum absolute price difference (in
+    cents per kWh) and the maximum relative cost difference for each bound.
+    '''
+    horizon = portable.meta['horizon']
+    price_error = 0.0
+    for state in portable.meta['price_states']:
+        expected = np.fromiter(myr.predict_prices(state, horizon), dtype=float)
+        price_error = max(price_error, float(np.abs(portable.predict_prices(state, horizon) - expected).max()))
+    cost_error = {k: 0.0 for k in bounds}
+    for state in portable.cost_states():
+        expected = myr.predict_costs(state, sizes)
+        actual = portable.predict_costs(state, sizes)
+        for k in bounds:
+            cost_error[k] = max(cost_error[k], float((np.abs(actual[k] - expected[k]) / expected[k]).max()))
+    return {'predict_prices': price_error, 'predict_cost': cost_error}
+
+def parity_failures(parity, price_tol=price_tolerance, cost_tol=cost_tolerance):
+    '''
+    Return a list of messages for the differences in the output of check_parity that exceed the tolerances.
+    '''
+    failures = []
+    if not parity['predict_prices'] <= price_tol:
+        failures.append("prices differ by up to {:.2e} cents per kWh (tolerance {:.2e})".format(
+            parity['predict_prices'], price_tol))
+    for k in bounds:
+        if not parity['predict_cost'][k] <= cost_tol:
+            failures.append("{} costs differ by up to {:.2e} (tolerance {:.2e})".format(
+                k, parity['predict_cost'][k], cost_tol))
+    return failures
+
+def main():
+    from r import R
+    parser = argparse.ArgumentParser(description="Export the R models into a portable archive.")
+    parser.add_argument('model_path', help="directory holding the R model objects")
+    parser.add_argument('artifact_path', help="where to write the archive, e.g. canisolar_models.npz")
+    parser.add_argument('--horizon', type=int, default=360, help="number of months of prices to export")
+    parser.add_argument('--check', action='store_true', help="only check an existing archive against R")
+    parser.add_argument('--price-tolerance', type=float, default=price_tolerance, help="largest price difference allowed")
+    parser.add_argument('--cost-tolerance', type=float, default=cost_tolerance, help="largest relative cost difference allowed")
+    args = parser.parse_args()
+    myr = R(args.model_path)
+    if args.check:
+        portable = PortableR(args.artifact_path)
+    else:
+        portable = export_models(myr, args.artifact_path, horizon=args.horizon)
+        print("Exported models (version {}) to {}".format(artifact_version, portable.model_path))
+    parity = check_parity(portable, myr)
+    print("Maximum absolute price difference (cents per kWh): {:.2e}".format(parity['predict_prices']))
+    for k in bounds:
+        print("Maximum relative cost difference ({}): {:.2e}".format(k, parity['predict_cost'][k]))
+    failures = parity_failures(parity, args.price_tolerance, args.cost_tolerance)
+    for failure in failures:
+        print("Parity check failed:", failure)
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -8,16 +8,25 @@ R class that takes care of loading saved objects, and provides prediction functi
 """
 
 import os
-import rpy2.robjects as ro
+import numpy as np
+from cache import LRUCache
 
 class R(object):
     '''
     We will load all objects in the model_path directory.
     '''
     def __init__(self, model_path):
+        # rpy2 starts an embedded R when it is imported, so we only import it once an R instance is needed.
+        # The R-free runtime (see portable.py) never does.
+        import rpy2.robjects as ro
         self.model_path = model_path
         self.r = ro.r
-        for file in os.listdir(model_path):
+        self.load_models()
+    def load_models(self):
+        '''
+        (Re)load all objects in the model_path directory.
+        '''
+        for file in os.listdir(self.model_path):
             if file.endswith("Robj"):
                 self.r.load(os.path.join(self.model_path, file))
         self.r('''library(forecast)''')
@@ -27,22 +36,95 @@ class R(object):
         Don't use this method, it's outdated.
         '''
         # What does it mean to not include random effects here?
-        cost = ro.r('''exp(predict(mod_ml_varslope_nested_year_state, newdata=data.frame(state='{state}', size={size}), re.form=NA))'''.format(state=state, size=size))        
+        cost = self.r('''exp(predict(mod_ml_varslope_nested_year_state, newdata=data.frame(state='{state}', size={size}), re.form=NA))'''.format(state=state, size=size))        
         return cost[0]
     def predict_cost(self, state, size):
         '''
         Return cost in dollars based on a pre-calculated model in R. Hardcoded year of 2014 right now.
         This particular model returns a cost dict with the point estimate and 90% lower and upper prediction interval bounds.
         '''
-        fit, lwr, upr = ro.r('''exp(predict(mod_fe_state_year, newdata=data.frame(state='{state}', size={size}, year_installed="2014"), interval="prediction", level=0.90))'''.format(state=state, size=size))        
+        fit, lwr, upr = self.r('''exp(predict(mod_fe_state_year, newdata=data.frame(state='{state}', size={size}, year_installed="2014"), interval="prediction", level=0.90))'''.format(state=state, size=size))        
+        cost = {'fit': fit, 'lwr': lwr, 'upr': upr}
+        return cost
+    def predict_costs(self, state, sizes):
+        '''
+        Vectorized version of predict_cost: return a cost dict of numpy arrays, one element per size in sizes, 
+        using a single call into R instead of one call per size.
+        '''
+        sizes = ', '.join(repr(float(size)) for size in sizes)
+        preds = self.r('''exp(predict(mod_fe_state_year, newdata=data.frame(state='{state}', size=c({sizes}), year_installed="2014"), interval="prediction", level=0.90))'''.format(state=state, sizes=sizes))
+        # R matrices are stored in column-major order, so the fit, lwr and upr columns follow one another
+        fit, lwr, upr = np.fromiter(preds, dtype=float).reshape(3, -1)
         cost = {'fit': fit, 'lwr': lwr, 'upr': upr}
         return cost
+    def cost_states(self):
+        '''
+        Return a list of the states that the cost model was fit on.
+        '''
+        return list(self.r('''mod_fe_state_year$xlevels$state'''))
     def predict_prices(self, state, periods):
         '''
         Return forecasted prices for a given state and number of periods (after March 2015)
         '''
-        prices = ro.r('''mypredict(ts_model_list[['{state}']], {periods})'''.format(state=state, periods=periods))     
+        prices = self.r('''mypredict(ts_model_list[['{state}']], {periods})'''.format(state=state, periods=periods))     
+        return prices
+
+class CachedR(object):
+    '''
+    Memoizing wrapper with the same prediction interface as R. Price forecasts are deterministic per state, 
+    so they are cached by (state, periods). Costs are cached by (state, size bucket), where sizes are rounded 
+    to the nearest size_resolution kW and predicted at the rounded size, so that every size in a bucket 
+    gets the same answer. Call reload() whenever the models on disk change.
+    '''
+    def __init__(self, r, maxsize=1024, size_resolution=0.01):
+        self.r = r
+        self.size_resolution = size_resolution
+        self.price_cache = LRUCache(maxsize)
+        self.cost_cache = LRUCache(maxsize)
+    def size_bucket(self, size):
+        '''Return the size (in kW) that a requested size is rounded to.'''
+        return round(round(float(size) / self.size_resolution) * self.size_resolution, 6)
+    def predict_cost(self, state, size):
+        '''
+        Cached version of R.predict_cost.
+        '''
+        size = self.size_bucket(size)
+        cost = self.cost_cache.get_or_compute((state, size), self.r.predict_cost, state, size)
+        # Return a copy, so that callers can't modify the cached dict
+        return dict(cost)
+    def predict_costs(self, state, sizes):
+        '''
+        Cached version of R.predict_costs. Only the sizes that aren't cached yet are sent to R, in one call.
+        '''
+        sizes = [self.size_bucket(size) for size in sizes]
+        costs = {size: self.cost_cache.get((state, size)) for size in set(sizes)}
+        missing = sorted(size for size, cost in costs.items() if cost is None)
+        if missing:
+            preds = self.r.predict_costs(state, missing)
+            for i, size in enumerate(missing):
+                costs[size] = {k: float(preds[k][i]) for k in ('fit', 'lwr', 'upr')}
+                self.cost_cache.put((state, size), costs[size])
+        return {k: np.array([costs[size][k] for size in sizes]) for k in ('fit', 'lwr', 'upr')}
+    def predict_prices(self, state, periods):
+        '''
+        Cached version of R.predict_prices. Returns a read-only numpy array.
+        '''
+        return self.price_cache.get_or_compute((state, periods), self._predict_prices, state, periods)
+    def _predict_prices(self, state, periods):
+        prices = np.fromiter(self.r.predict_prices(state, periods), dtype=float)
+        prices.flags.writeable = False
         return prices
+    def invalidate(self):
+        '''Drop all cached predictions.'''
+        self.price_cache.clear()
+        self.cost_cache.clear()
+    def reload(self):
+        '''Reload the models from disk and drop all cached predictions, which may be stale.'''
+        self.r.load_models()
+        self.invalidate()
+    def stats(self):
+        '''Return hit/miss statistics for the price and cost caches.'''
+        return {'predict_prices': self.price_cache.stats(), 'predict_cost': self.cost_cache.stats()}
 
 def main():
     pass
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:19:47 2026
+
+@author: gjm
+
+This file defines the InsolationRaster class, a precomputed lat/lon grid of insolation values.
+
+build_raster reads the same NREL shapefile as Insolation.populate and, for every cell of a
+regular grid, stores the 12 monthly kWh / m2 / day values of the first polygon containing the
+cell's center (NaN where there's no data) as float32 in a .npy file. InsolationRaster memory
+maps that file, so that every uWSGI worker shares the same pages through the OS cache, and a
+lookup is just an index computation plus one slice. Run this file to build a raster and
+report its accuracy against poly_find on polygon border cells:
+
+    python raster.py /path/to/us9809_latilt_updated ../models/insolation_raster.npy --resolution 0.05
+"""
+
+import argparse
+import json
+import math
+import random
+import numpy as np
+from insolation import shapefile_docs, month_abbrs, PolyFindError
+from spatial import contains_points
+
+def build_raster(docs, path, resolution=0.05):
+    '''
+    Rasterize a list of insolation documents (see insolation.shapefile_docs) at resolution degrees, and save the
+    raster to path (a .npy file) along with its extent in path + '.json'. Returns an InsolationRaster.
+    '''
+    docs = list(docs)
+    rings = [np.array(doc['loc']['coordinates'][0], dtype=float) for doc in docs]
+    lo = np.min([ring.min(axis=0) for ring in rings], axis=0)
+    hi = np.max([ring.max(axis=0) for ring in rings], axis=0)
+    # Snap the extent to the grid
+    lon0, lat0 = np.floor(lo / resolution) * resolution
+    cols = int(math.ceil((hi[0] - lon0) / resolution))
+    rows = int(math.ceil((hi[1] - lat0) / resolution))
+    values = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(rows, cols, 12))
+    values[:] = np.nan
+    filled = np.zeros((rows, cols), dtype=bool)
+    for doc, ring in zip(docs, rings):
+        # Cells whose centers fall within the polygon's bounding box
+        c0, r0 = np.floor((ring.min(axis=0) - (lon0, lat0)) / resolution).astype(int)
+        c1, r1 = np.floor((ring.max(axis=0) - (lon0, lat0)) / resolution).astype(int)
+        r, c = np.mgrid[r0:r1 + 1, c0:c1 + 1]
+        r, c = r.ravel(), c.ravel()
+        keep = (r < rows) & (c < cols)
+        r, c = r[keep], c[keep]
+        inside = contains_points(ring, lon0 + (c + 0.5) * resolution, lat0 + (r + 0.5) * resolution)
+        # Like get_insolation, the first polygon wins
+        keep = inside & ~filled[r, c]
+        r, c = r[keep], c[keep]
+        values[r, c] = [doc['attributes'][abbr] for abbr in month_abbrs]
+        filled[r, c] = True
+    values.flush()
+    del values
+    with open(path + '.json', 'w') as f:
+        json.dump({'lon0': float(lon0), 'lat0': float(lat0), 'resolution': resolution, 'rows': rows, 'cols': cols}, f)
+    return InsolationRaster(path)
+
+class InsolationRaster(object):
+    '''
+    Memory map a raster made by build_raster. It can be passed to Insolation as its index.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.json', 'r') as f:
+            extent = json.load(f)
+        self.lon0 = extent['lon0']
+        self.lat0 = extent['lat0']
+        self.resolution = extent['resolution']
+        self.values = np.load(path, mmap_mode='r')
+        self.rows, self.cols = self.values.shape[:2]
+    def cell(self, lon, lat):
+        '''Return the (row, column) of the cell containing (lon, lat), or None if it's outside the raster.'''
+        r = int((lat - self.lat0) // self.resolution)
+        c = int((lon - self.lon0) // self.resolution)
+        if 0 <= r < self.rows and 0 <= c < self.cols:
+            return r, c
+        return None
+    def lookup(self, lon, lat):
+        '''Return the 12 monthly insolation values at (lon, lat), or None if there's no data there.'''
+        cell = self.cell(lon, lat)
+        if cell is None:
+            return None
+        values = self.values[cell]
+        if np.isnan(values[0]):
+            return None
+        return values
+    def find(self, lon, lat):
+        '''
+        Same interface as spatial.PolygonIndex.find, so that Insolation can use the raster as its index. The
+        document id is the cell, and it only holds the monthly values.
+        '''
+        values = self.lookup(lon, lat)
+        if values is None:
+            return []
+        monthly = values.tolist()
+        return [{'_id': self.cell(lon, lat), 'attributes': dict(zip(month_abbrs, monthly)), 'monthly': monthly}]
+
+def check_raster(raster, insolation, points=1000, seed=0):
+    '''
+    Compare the raster against insolation.poly_find at random points in border cells (cells with a neighbor that
+    holds different values), where rasterization error is concentrated. Returns a dict with the number of points
+    checked, how many of them differ, and the largest absolute difference (in kWh / m2 / day).
+    '''
+    values = np.asarray(raster.values)
+    differs = np.zeros(values.shape[:2], dtype=bool)
+    for axis in (0, 1):
+        step = np.any(np.diff(values, axis=axis) != 0, axis=2)
+        if axis == 0:
+            differs[1:] |= step
+            differs[:-1] |= step
+        else:
+            differs[:, 1:] |= step
+            differs[:, :-1] |= step
+    border = np.argwhere(differs & ~np.isnan(values[:, :, 0]))
+    rnd = random.Random(seed)
+    checked = mismatches = 0
+    max_error = 0.0
+    for _ in range(min(points, len(border))):
+        r, c = border[rnd.randrange(len(border))]
+        lon = raster.lon0 + (c + rnd.random()) * raster.resolution
+        lat = raster.lat0 + (r + rnd.random()) * raster.resolution
+        try:
+            expected = insolation.get_insolation(lon, lat)['kWhpm2'].values
+        except PolyFindError:
+            expected = None
+        actual = raster.lookup(lon, lat)
+        checked += 1
+        if expected is None or actual is None:
+            mismatches += (expected is None) != (actual is None)
+            continue
+        error = float(np.abs(expected - actual).max())
+        mismatches += error > 1e-4
+        max_error = max(max_error, error)
+    return {'points': checked, 'mismatches': mismatches, 'max_error': max_error}
+
+def main():
+    from insolation import Insolation
+    parser = argparse.ArgumentParser(description="Build a memory-mapped insolation raster from the NREL shapefile.")
+    parser.add_argument('shapefile', help="path to the NREL insolation shapefile")
+    parser.add_argument('raster_path', help="where to write the raster, e.g. insolation_raster.npy")
+    parser.add_argument('--resolution', type=float, default=0.05, help="cell size in degrees")
+    parser.add_argument('--points', type=int, default=1000, help="number of border points to check")
+    args = parser.parse_args()
+    raster = build_raster(shapefile_docs(args.shapefile), args.raster_path, args.resolution)
+    print("Built a {} x {} raster at {} degrees: {}".format(raster.rows, raster.cols, raster.resolution, raster.path))
+    accuracy = check_raster(raster, Insolation(), args.points)
+    print("Border points checked: {}, differing from poly_find: {} ({:.1%}), largest difference: {:.3f} kWh/m2/day".format(
+        accuracy['points'], accuracy['mismatches'], accuracy['mismatches'] / max(accuracy['points'], 1),
+        accuracy['max_error']))
+
+if __name__ == "__main__":
+    main()
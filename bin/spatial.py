@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:18:51 2026
+
+@author: gjm
+
+This file defines the PolygonIndex class, an in-process alternative to the MongoDB
+$geoIntersects query that Insolation.poly_find runs for every request.
+
+The NREL insolation polygons are static, so we load them once and bucket them into a grid of
+bounding boxes. A lookup only tests the polygons in the point's grid cell, first against their
+bounding boxes and then with an exact (planar) point-in-polygon test. Matches are returned in
+the order the polygons were loaded, which is the order MongoDB returns them in, so the first
+match is the same polygon that get_insolation would use. Run this file to compare it against
+the MongoDB path:
+
+    python spatial.py --points 1000
+"""
+
+import argparse
+import math
+import random
+import time
+import numpy as np
+
+class PolygonIndex(object):
+    '''
+    Pass a list of documents shaped like those in the insolation collection, i.e. each with a 'loc'
+    GeoJSON Polygon and 'attributes'. The outer ring of each polygon is indexed.
+    '''
+    def __init__(self, docs, cell_size=0.5):
+        self.cell_size = cell_size
+        self.docs = []
+        self.rings = []
+        self.cells = {}
+        for doc in docs:
+            ring = np.array(doc['loc']['coordinates'][0], dtype=float)
+            i = len(self.docs)
+            # We don't need the geometry once it's been indexed
+            self.docs.append({k: v for k, v in doc.items() if k != 'loc'})
+            self.rings.append(ring)
+            (x0, y0), (x1, y1) = ring.min(axis=0), ring.max(axis=0)
+            for cx in range(self.cell(x0), self.cell(x1) + 1):
+                for cy in range(self.cell(y0), self.cell(y1) + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
+        self.bboxes = np.array([np.concatenate([ring.min(axis=0), ring.max(axis=0)]) for ring in self.rings]).reshape(-1, 4)
+    def __len__(self):
+        return len(self.docs)
+    @classmethod
+    def from_collection(cls, collection, cell_size=0.5):
+        '''Build an index from a MongoDB collection, e.g. Insolation().db.insolation.'''
+        return cls(collection.find(), cell_size)
+    def cell(self, coordinate):
+        '''Return the grid cell number of a longitude or latitude.'''
+        return int(math.floor(coordinate / self.cell_size))
+    def find(self, lon, lat):
+        '''
+        Return a list of documents whose polygons contain the point (lon, lat), in load order.
+        '''
+        found = []
+        for i in self.cells.get((self.cell(lon), self.cell(lat)), []):
+            x0, y0, x1, y1 = self.bboxes[i]
+            if x0 <= lon <= x1 and y0 <= lat <= y1 and contains(self.rings[i], lon, lat):
+                found.append(self.docs[i])
+        return found
+
+def contains(ring, x, y):
+    '''
+    Return True if the point (x, y) is inside the polygon ring (an array of (x, y) vertices), by counting how
+    many edges a ray cast from the point towards +x crosses. Points on an edge may go either way.
+    '''
+    xs, ys = ring[:, 0], ring[:, 1]
+    xp, yp = np.roll(xs, 1), np.roll(ys, 1)
+    # Edges that straddle the ray's latitude; these never have yp == ys, so the division is safe
+    straddle = (ys > y) != (yp > y)
+    xs, ys, xp, yp = xs[straddle], ys[straddle], xp[straddle], yp[straddle]
+    x_cross = xs + (y - ys) * (xp - xs) / (yp - ys)
+    return np.count_nonzero(x < x_cross) % 2 == 1
+
+def contains_points(ring, xs, ys):
+    '''
+    Vectorized version of contains: return a boolean array telling which of the points (xs[i], ys[i]) are
+    inside the polygon ring. Loops over the edges of the ring rather than over the points.
+    '''
+    inside = np.zeros(len(xs), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(np.roll(ring, 1, axis=0), ring):
+        if y0 == y1:
+            # Horizontal edges never straddle a ray
+            continue
+        straddle = (ys > y1) != (ys > y0)
+        x_cross = x1 + (ys - y1) * (x0 - x1) / (y0 - y1)
+        inside ^= straddle & (xs < x_cross)
+    return inside
+
+def benchmark(index, insolation, points=1000, seed=0):
+    '''
+    Time the in-process index against MongoDB on points sampled inside random polygons, and count the points
+    for which they disagree about the first match. Returns a dict of results.
+    '''
+    rnd = random.Random(seed)
+    sample = []
+    for i in (rnd.randrange(len(index)) for _ in range(points)):
+        # Pick a point a little way from a random vertex, towards the centroid, so that it's inside the polygon
+        ring = index.rings[i]
+        vertex = ring[rnd.randrange(len(ring))]
+        lon, lat = vertex + (ring.mean(axis=0) - vertex) * rnd.uniform(0.05, 0.95)
+        sample.append((float(lon), float(lat)))
+    start = time.perf_counter()
+    memory = [index.find(lon, lat) for lon, lat in sample]
+    memory_time = time.perf_counter() - start
+    start = time.perf_counter()
+    mongo = [list(insolation.db.insolation.find({"loc": {"$geoIntersects": {"$geometry":
+        {"type": "Point", "coordinates": [lon, lat]}}}})) for lon, lat in sample]
+    mongo_time = time.perf_counter() - start
+    mismatches = sum(1 for a, b in zip(memory, mongo)
+                     if [doc['_id'] for doc in a[:1]] != [doc['_id'] for doc in b[:1]])
+    return {'points': points, 'memory_us_per_lookup': memory_time / points * 1e6,
+            'mongo_us_per_lookup': mongo_time / points * 1e6, 'mismatches': mismatches}
+
+def main():
+    from insolation import Insolation
+    parser = argparse.ArgumentParser(description="Benchmark the in-process insolation index against MongoDB.")
+    parser.add_argument('--points', type=int, default=1000, help="number of lookups")
+    parser.add_argument('--cell-size', type=float, default=0.5, help="grid cell size in degrees")
+    args = parser.parse_args()
+    insolation = Insolation()
+    start = time.perf_counter()
+    index = PolygonIndex.from_collection(insolation.db.insolation, args.cell_size)
+    print("Loaded {} polygons in {:.2f} s".format(len(index), time.perf_counter() - start))
+    results = benchmark(index, insolation, args.points)
+    print("In-process: {:.1f} us per lookup".format(results['memory_us_per_lookup']))
+    print("MongoDB: {:.1f} us per lookup".format(results['mongo_us_per_lookup']))
+    print("Points where the first match differs: {} of {}".format(results['mismatches'], results['points']))
+
+if __name__ == "__main__":
+    main()
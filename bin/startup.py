@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 06:18:15 2026
+
+@author: gjm
+
+This file takes care of lazy initialization of the heavy subsystems (models, database
+clients, key material), and of measuring how long startup takes.
+
+Subsystems are wrapped in Lazy objects, which build them on first use and record how long
+that took. warm_up() builds them all at once; the web app calls it before uWSGI forks its
+workers, so that respawned workers don't pay for it again. Run this file to get a report of
+per-module import and per-subsystem initialization times, checked against a budget:
+
+    python startup.py --warm-up --budget 5
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import argparse
+import importlib
+import sys
+import threading
+import time
+
+# Seconds spent importing modules and initializing subsystems, in the order they happened
+timings = OrderedDict()
+
+@contextmanager
+def timed(name):
+    '''Record the wall clock time spent in the body of the with statement under name.'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+class Lazy(object):
+    '''
+    Proxy for an object that is expensive to build. The object is built by calling factory() the first time
+    one of its attributes is accessed (or get() is called), and attribute access is passed through to it.
+    '''
+    registry = []
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.value = None
+        self.lock = threading.Lock()
+        Lazy.registry.append(self)
+    def get(self):
+        '''Return the wrapped object, building it if necessary.'''
+        if self.value is None:
+            with self.lock:
+                if self.value is None:
+                    with timed('init ' + self.name):
+                        self.value = self.factory()
+        return self.value
+    def reset(self):
+        '''Drop the wrapped object, so that it is built again on next use.'''
+        with self.lock:
+            self.value = None
+    def __getattr__(self, attr):
+        # Only called for attributes that Lazy itself doesn't have
+        return getattr(self.get(), attr)
+
+def warm_up(names=None):
+    '''
+    Build the lazy subsystems with the given names (all of them by default) now, rather than on first use.
+    A subsystem that fails to build is reported and left for its first use, so that e.g. a missing optional
+    model file can't keep the app from starting.
+    '''
+    for lazy in Lazy.registry:
+        if names is None or lazy.name in names:
+            try:
+                lazy.get()
+            except Exception as e:
+                print("Couldn't warm up {}, so it will be built on first use: {!r}".format(lazy.name, e))
+
+def profile_imports(modules):
+    '''
+    Import each of the modules in order, recording the time each one adds. Modules imported earlier
+    (directly or as a dependency) aren't counted again, so the times add up to the total.
+    '''
+    for module in modules:
+        if module not in sys.modules:
+            with timed('import ' + module):
+                importlib.import_module(module)
+
+def report(budget=None):
+    '''
+    Print the recorded timings, and return True if their total is within budget seconds (or if there's no budget).
+    '''
+    total = sum(timings.values())
+    for name, seconds in timings.items():
+        print("{:<40} {:>8.3f} s".format(name, seconds))
+    print("{:<40} {:>8.3f} s".format("total", total))
+    if budget is not None and total > budget:
+        print("Startup took {:.3f} s, which exceeds the budget of {:.3f} s.".format(total, budget))
+        return False
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Report import and initialization times for a worker.")
+    parser.add_argument('modules', nargs='*', help="modules to import, in order",
+                        default=['numpy', 'pandas', 'pymysql', 'pymongo', 'flask', 'canisolar', 'app'])
+    parser.add_argument('--warm-up', action='store_true', help="also initialize all the lazy subsystems")
+    parser.add_argument('--budget', type=float, help="fail if startup takes longer than this many seconds")
+    args = parser.parse_args()
+    profile_imports(args.modules)
+    if args.warm_up:
+        warm_up()
+    if not report(args.budget):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()